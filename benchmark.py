@@ -0,0 +1,515 @@
+"""
+离线压测脚本
+
+启动本地模拟的 Minimax 接口（上传、生成、润色）和 Suno CDN，再以子进程方式启动 music.py，
+按给定的并发级别驱动 POST /api/generate 并跟踪 SSE 直到任务结束，
+输出端到端延迟的 p50 / p95 / p99、吞吐量和服务进程的峰值内存（RSS），整个过程不访问外网。
+
+示例：
+    python benchmark.py --concurrency 1,4,16 --requests 32
+    python benchmark.py --workers 2 --generation-latency 5 --error-rate 0.05
+    python benchmark.py --song-pool 4   # 只使用 4 首歌，测试缓存命中后的表现
+    # 同时有客户端缓慢下载大音频文件时，其他接口是否仍能及时响应
+    python benchmark.py --workers 1 --slow-readers 4
+    # 对比上传前截取参考音频的效果（需要 ffmpeg 和一个真实的 mp3 文件）
+    python benchmark.py --reference-audio song.mp3 --upload-bandwidth 2000000 --trim off
+    python benchmark.py --reference-audio song.mp3 --upload-bandwidth 2000000 --trim on
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+MUSIC_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'music.py')
+SLOW_READER_FILE = 'generated_music_20000101_000000.mp3'
+
+
+class FakeUpstream:
+    """
+    本地模拟的上游服务
+    每个接口按配置的平均延迟（带随机抖动）响应，按 error_rate 返回 500、按 throttle_rate 返回 429，
+    音频大小由 reference_bytes / generated_bytes 控制
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.calls = {'upload': 0, 'generation': 0, 'chat': 0, 'cdn': 0}
+        self.upload_bytes = 0
+        self.generated_audio = os.urandom(args.generated_bytes)
+        self.reference_audio = None
+        if args.reference_audio:
+            with open(args.reference_audio, 'rb') as f:
+                self.reference_audio = f.read()
+
+    def app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/v1/music_upload', self.upload)
+        app.router.add_post('/v1/music_generation', self.generation)
+        app.router.add_post('/v1/text/chatcompletion_v2', self.chat)
+        app.router.add_get('/cdn/{song_id}.mp3', self.cdn)
+        return app
+
+    async def _delay(self, mean):
+        if mean > 0:
+            jitter = self.args.jitter
+            await asyncio.sleep(mean * random.uniform(1 - jitter, 1 + jitter))
+
+    def _injected_failure(self):
+        """按配置的概率返回注入的错误响应，不注入时返回 None"""
+        roll = random.random()
+        if roll < self.args.throttle_rate:
+            return web.json_response({'message': 'rate limited'}, status=429, headers={'Retry-After': '1'})
+        if roll < self.args.throttle_rate + self.args.error_rate:
+            return web.json_response({'message': 'injected error'}, status=500)
+        return None
+
+    async def upload(self, request):
+        self.calls['upload'] += 1
+        # 读完整个请求体，并按配置的带宽模拟传输耗时
+        size = 0
+        async for chunk in request.content.iter_chunked(65536):
+            size += len(chunk)
+        self.upload_bytes += size
+        await self._delay(self.args.upload_latency)
+        if self.args.upload_bandwidth:
+            await asyncio.sleep(size / self.args.upload_bandwidth)
+        failure = self._injected_failure()
+        if failure:
+            return failure
+        return web.json_response({
+            'voice_id': f'voice-{random.getrandbits(32):08x}',
+            'instrumental_id': f'inst-{random.getrandbits(32):08x}',
+            'base_resp': {'status_code': 0}
+        })
+
+    async def generation(self, request):
+        self.calls['generation'] += 1
+        await request.post()
+        await self._delay(self.args.generation_latency)
+        failure = self._injected_failure()
+        if failure:
+            return failure
+        body = json.dumps({
+            'data': {'audio': self.generated_audio.hex(), 'status': 2},
+            'base_resp': {'status_code': 0, 'status_msg': 'success'}
+        }).encode()
+        return web.Response(body=body, content_type='application/json')
+
+    async def chat(self, request):
+        self.calls['chat'] += 1
+        payload = await request.json()
+        failure = self._injected_failure()
+        if failure:
+            await self._delay(self.args.chat_latency)
+            return failure
+        lyrics = payload['messages'][-1]['content']
+        if not payload.get('stream'):
+            await self._delay(self.args.chat_latency)
+            return web.json_response({
+                'choices': [{'message': {'content': lyrics}}],
+                'base_resp': {'status_code': 0}
+            })
+
+        # 流式响应：把延迟均摊到各个增量数据块之间
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        pieces = [lyrics[i:i + 8] for i in range(0, len(lyrics), 8)] or ['']
+        for piece in pieces:
+            await self._delay(self.args.chat_latency / len(pieces))
+            chunk = {'choices': [{'delta': {'content': piece}}]}
+            await response.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode())
+        final = {'choices': [{'message': {'content': lyrics}}], 'base_resp': {'status_code': 0}}
+        await response.write(f'data: {json.dumps(final, ensure_ascii=False)}\n\n'.encode())
+        await response.write_eof()
+        return response
+
+    async def cdn(self, request):
+        self.calls['cdn'] += 1
+        await self._delay(self.args.cdn_latency)
+        if self.reference_audio is not None:
+            # 真实音频在末尾附加歌曲 ID，使每首歌的内容哈希不同
+            body = self.reference_audio + request.match_info['song_id'].encode()
+            return web.Response(body=body, content_type='audio/mpeg')
+        # 同一首歌每次返回相同的内容，便于测试上传缓存
+        seed = hashlib.sha256(request.match_info['song_id'].encode()).digest()
+        body = (seed * (self.args.reference_bytes // len(seed) + 1))[:self.args.reference_bytes]
+        return web.Response(body=body, content_type='audio/mpeg')
+
+
+class UpstreamThread:
+    """在独立线程的事件循环中运行模拟服务，避免和压测客户端互相影响"""
+
+    def __init__(self, upstream, port):
+        self.upstream = upstream
+        self.port = port
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='fake-upstream', daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        runner = web.AppRunner(self.upstream.app(), access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(runner.cleanup())
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return f'http://127.0.0.1:{self.port}'
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+def process_tree(root_pid):
+    """服务主进程及其所有子进程（ASGI worker）的 pid，仅支持 Linux"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def read_status_kb(pid, field):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler:
+    """定期采样服务进程树的 RSS 总和，记录峰值"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            total = sum(read_status_kb(pid, 'VmRSS') for pid in process_tree(self.pid))
+            self.peak_kb = max(self.peak_kb, total)
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def reset(self):
+        self.peak_kb = 0
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_server(args, upstream_url, workdir):
+    """以子进程方式启动 music.py，工作目录为临时目录，所有缓存和生成文件都写在其中"""
+    env = dict(os.environ)
+    env.update({
+        'MINIMAX_API_KEY': env.get('BENCHMARK_API_KEY', 'benchmark-key'),
+        'MINIMAX_GROUP_ID': 'benchmark-group',
+        'MINIMAX_BASE_URL': upstream_url,
+        'SUNO_CDN_URL': f'{upstream_url}/cdn',
+        'PORT': str(args.port),
+        'ASGI_WORKERS': str(args.workers),
+        'LOG_LEVEL': args.log_level,
+        'LOG_FILE': os.path.join(workdir, 'app.log'),
+        'GENERATE_MAX_PENDING': str(max(args.requests, 100)),
+        'REFERENCE_TRIM': args.trim,
+    })
+    if args.slow_readers:
+        # 旧版本平铺存放的音频文件名，/audio/ 可以直接访问
+        os.makedirs(os.path.join(workdir, 'downloads'), exist_ok=True)
+        with open(os.path.join(workdir, 'downloads', SLOW_READER_FILE), 'wb') as f:
+            f.write(os.urandom(args.slow_reader_bytes))
+    log = open(os.path.join(workdir, 'server.out'), 'wb')
+    process = subprocess.Popen([sys.executable, MUSIC_PY], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+
+async def wait_until_ready(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'服务进程已退出，返回码 {process.returncode}')
+            try:
+                async with session.get(f'{base_url}/api/stats') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('等待服务启动超时')
+
+
+async def follow_events(session, url):
+    """读取 SSE 直到 done / failed，返回最后一个事件名"""
+    event = None
+    async with session.get(url) as response:
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').strip()
+            if line.startswith('event:'):
+                event = line[len('event:'):].strip()
+            elif line.startswith('data:') and event in ('done', 'failed'):
+                return event
+    return event
+
+
+async def one_request(session, base_url, index, args, run_id):
+    """提交一个生成任务并等待结束，返回 (结果, 耗时秒)"""
+    key = index % args.song_pool if args.song_pool else f'{run_id}-{index}'
+    payload = {
+        'suno_url': f'https://suno.com/song/song-{key}',
+        'lyrics': f'第{key}首\n' + '啦' * args.lyrics_chars
+    }
+    started = time.monotonic()
+    async with session.post(f'{base_url}/api/generate', json=payload) as response:
+        if response.status == 503:
+            return 'rejected', time.monotonic() - started
+        data = await response.json()
+        if response.status != 202:
+            return 'error', time.monotonic() - started
+    event = await follow_events(session, base_url + data['events_url'])
+    return ('succeeded' if event == 'done' else 'failed'), time.monotonic() - started
+
+
+async def slow_reader(session, base_url, stop):
+    """以每秒约 32KB 的速度下载音频文件，占住服务端的连接直到 stop 被设置"""
+    while not stop.is_set():
+        try:
+            async with session.get(f'{base_url}/audio/{SLOW_READER_FILE}') as response:
+                while not stop.is_set():
+                    if not await response.content.read(16384):
+                        break
+                    await asyncio.sleep(0.5)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            await asyncio.sleep(0.5)
+
+
+async def probe_api(session, base_url, stop, latencies, timeout=10):
+    """每 0.5 秒请求一次 /api/stats，记录响应时间，超时记为 None"""
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            async with session.get(f'{base_url}/api/stats', timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                await response.read()
+            latencies.append(time.monotonic() - started)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            latencies.append(None)
+        await asyncio.sleep(0.5)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_level(base_url, concurrency, args, sampler):
+    """以固定并发数发送 args.requests 个请求"""
+    run_id = f'c{concurrency}-{random.getrandbits(24):06x}'
+    counter = iter(range(args.requests))
+    results = []
+    connector = aiohttp.TCPConnector(limit=concurrency * 2 + 4)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.request_timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def worker():
+            for index in counter:
+                try:
+                    results.append(await one_request(session, base_url, index, args, run_id))
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    results.append(('error', float('nan')))
+
+        # 缓慢下载音频的客户端和接口探测使用独立的连接，不占用上面的连接数
+        background = aiohttp.ClientSession(timeout=timeout)
+        stop = asyncio.Event()
+        probe_latencies = []
+        tasks = [asyncio.ensure_future(slow_reader(background, base_url, stop)) for _ in range(args.slow_readers)]
+        if args.slow_readers:
+            # 先让下载占满连接，再开始探测和发送请求
+            await asyncio.sleep(1)
+            tasks.append(asyncio.ensure_future(probe_api(background, base_url, stop, probe_latencies)))
+
+        sampler.reset()
+        started = time.monotonic()
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            elapsed = time.monotonic() - started
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await background.close()
+
+    latencies = [latency for outcome, latency in results if outcome == 'succeeded']
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    result = {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'outcomes': outcomes,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        'p50': round(percentile(latencies, 0.50), 3),
+        'p95': round(percentile(latencies, 0.95), 3),
+        'p99': round(percentile(latencies, 0.99), 3),
+        'peak_rss_mb': round(sampler.peak_kb / 1024, 1)
+    }
+    if args.slow_readers:
+        answered = [latency for latency in probe_latencies if latency is not None]
+        result['probe'] = {
+            'requests': len(probe_latencies),
+            'timeouts': len(probe_latencies) - len(answered),
+            'p95': round(percentile(answered, 0.95), 3),
+            'max': round(max(answered, default=float('nan')), 3)
+        }
+    return result
+
+
+def print_report(results, upstream, hwm_kb):
+    header = f"{'并发':>6} {'请求':>6} {'成功':>6} {'失败':>6} {'拒绝':>6} {'p50(s)':>9} {'p95(s)':>9} {'p99(s)':>9} {'吞吐(/s)':>10} {'峰值RSS(MB)':>12}"
+    print(header)
+    print('-' * len(header))
+    for item in results:
+        outcomes = item['outcomes']
+        print(
+            f"{item['concurrency']:>6} {item['requests']:>6} {outcomes.get('succeeded', 0):>6} "
+            f"{outcomes.get('failed', 0) + outcomes.get('error', 0):>6} {outcomes.get('rejected', 0):>6} "
+            f"{item['p50']:>9.3f} {item['p95']:>9.3f} {item['p99']:>9.3f} {item['throughput']:>10.3f} {item['peak_rss_mb']:>12.1f}"
+        )
+    for item in results:
+        if 'probe' in item:
+            probe = item['probe']
+            print(f"并发 {item['concurrency']} 时 /api/stats 探测: {probe['requests']} 次，超时 {probe['timeouts']} 次，"
+                  f"p95 {probe['p95']:.3f}s，最长 {probe['max']:.3f}s")
+    print(f"\n上游调用次数: {json.dumps(upstream.calls)}")
+    print(f"上传总字节数: {upstream.upload_bytes}")
+    if hwm_kb:
+        print(f"服务进程 VmHWM 之和: {hwm_kb / 1024:.1f} MB")
+
+
+async def run_benchmark(args):
+    upstream = FakeUpstream(args)
+    upstream_thread = UpstreamThread(upstream, args.upstream_port)
+    upstream_url = upstream_thread.start()
+
+    workdir = tempfile.mkdtemp(prefix='music-bench-')
+    process, log = start_server(args, upstream_url, workdir)
+    base_url = f'http://127.0.0.1:{args.port}'
+    sampler = RssSampler(process.pid).start()
+    results = []
+    hwm_kb = 0
+    try:
+        await wait_until_ready(base_url, process)
+        for concurrency in args.concurrency:
+            result = await run_level(base_url, concurrency, args, sampler)
+            results.append(result)
+            print(f"并发 {concurrency} 完成: {json.dumps(result, ensure_ascii=False)}", flush=True)
+        hwm_kb = sum(read_status_kb(pid, 'VmHWM') for pid in process_tree(process.pid))
+    finally:
+        sampler.stop()
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        upstream_thread.stop()
+        if args.keep_workdir:
+            print(f"工作目录: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_report(results, upstream, hwm_kb)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'args': vars(args),
+                'results': results,
+                'upstream_calls': upstream.calls,
+                'upload_bytes': upstream.upload_bytes
+            }, f, ensure_ascii=False, indent=2)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='music.py 离线压测')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        type=lambda value: [int(item) for item in value.split(',') if item],
+                        help='逗号分隔的并发级别')
+    parser.add_argument('--requests', type=int, default=32, help='每个并发级别发送的请求数')
+    parser.add_argument('--workers', type=int, default=0, help='ASGI worker 进程数，0 表示 Flask 开发服务器')
+    parser.add_argument('--port', type=int, default=5055, help='被测服务的端口')
+    parser.add_argument('--upstream-port', type=int, default=0, help='模拟上游服务的端口，0 表示随机')
+    parser.add_argument('--song-pool', type=int, default=0, help='循环使用的歌曲/歌词数量，0 表示每个请求都不同（缓存全部未命中）')
+    parser.add_argument('--lyrics-chars', type=int, default=200, help='歌词长度（字符）')
+    parser.add_argument('--upload-latency', type=float, default=0.3, help='上传接口平均延迟（秒）')
+    parser.add_argument('--generation-latency', type=float, default=2.0, help='生成接口平均延迟（秒）')
+    parser.add_argument('--chat-latency', type=float, default=0.5, help='润色接口平均延迟（秒）')
+    parser.add_argument('--cdn-latency', type=float, default=0.1, help='Suno CDN 平均延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.2, help='延迟的随机抖动比例')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='上游返回 500 的概率')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='上游返回 429 的概率')
+    parser.add_argument('--reference-bytes', type=int, default=3 * 1024 * 1024, help='Suno 原曲大小（字节）')
+    parser.add_argument('--reference-audio', help='模拟 CDN 返回的真实 mp3 文件，代替随机内容（测试参考音频截取时使用）')
+    parser.add_argument('--upload-bandwidth', type=float, default=0, help='模拟上传带宽（字节/秒），0 表示不限')
+    parser.add_argument('--trim', default='off', choices=['auto', 'on', 'off'], help='被测服务的 REFERENCE_TRIM 设置')
+    parser.add_argument('--generated-bytes', type=int, default=2 * 1024 * 1024, help='生成音频大小（字节）')
+    parser.add_argument('--slow-readers', type=int, default=0,
+                        help='压测期间缓慢下载音频文件的客户端数，同时探测 /api/stats 的响应时间')
+    parser.add_argument('--slow-reader-bytes', type=int, default=64 * 1024 * 1024, help='缓慢下载的音频文件大小（字节）')
+    parser.add_argument('--request-timeout', type=float, default=600, help='单个请求的读取超时（秒）')
+    parser.add_argument('--log-level', default='WARNING', help='被测服务的日志级别')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--keep-workdir', action='store_true', help='保留被测服务的临时工作目录')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    asyncio.run(run_benchmark(parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,6 @@ import os
 from dotenv import load_dotenv
 import logging
 
-# 设置日志级别
-logging.basicConfig(level=logging.DEBUG)
-
 # 打印当前目录
 current_dir = os.getcwd()
 print(f"Current directory: {current_dir}")
@@ -43,15 +40,38 @@ if not group_id:
 
 import requests
 import json
+import copy
 import base64
 import os
 import mimetypes
 import logging
+import logging.handlers
 import sys
+import queue
+import contextvars
+import re
+import time
+import hashlib
+import sqlite3
+import tempfile
+import shutil
+import subprocess
+from contextlib import closing, asynccontextmanager
+import atexit
+from collections import OrderedDict, defaultdict, deque
+import uuid
+import random
+import math
+import threading
+import functools
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from email.utils import parsedate_to_datetime
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory
+from requests.adapters import HTTPAdapter
+from werkzeug.security import safe_join
 import asyncio
 import aiohttp
+import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
@@ -63,516 +83,4571 @@ api_key = os.getenv('MINIMAX_API_KEY')
 if not api_key:
     print("Warning: MINIMAX_API_KEY not found in environment variables")
 
-# 配置日志处理器使用 utf-8 编码
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),  # 标准输出使用 stdout
-        logging.FileHandler('app.log', encoding='utf-8')  # 文件输出使用 utf-8 编码
+# 日志配置：生产环境默认 INFO，记录在请求/任务线程中只放入内存队列，由后台线程写入标准输出和按大小轮转的日志文件
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# 单条日志消息的最大字符数，超出部分截断
+LOG_MAX_MESSAGE_CHARS = int(os.getenv('LOG_MAX_MESSAGE_CHARS', '2000'))
+
+# 当前请求 / 任务的标识，由日志过滤器附加到每条记录上
+current_request_id = contextvars.ContextVar('current_request_id', default=None)
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+
+
+class LogContextFilter(logging.Filter):
+    """
+    在记录进入队列之前（仍在产生日志的线程中）完成以下处理：
+    附加 request_id / job_id，格式化消息和异常堆栈，脱敏 API key 和 Bearer token，
+    折叠大段十六进制音频数据，并截断过长的消息（堆栈保留末尾）
+    """
+    SECRET_PATTERNS = [
+        (re.compile(r'(Bearer\s+)[A-Za-z0-9._\-]+'), r'\1***'),
+        (re.compile(r'''(["']?(?:api_key|apikey|token)["']?\s*[:=]\s*["']?)[^"',\s}]+''', re.IGNORECASE), r'\1***'),
     ]
-)
+    HEX_PATTERN = re.compile(r'[0-9a-fA-F]{256,}')
+
+    def __init__(self, max_chars=LOG_MAX_MESSAGE_CHARS, secrets=()):
+        super().__init__()
+        self.max_chars = max_chars
+        # 过短的值容易误伤普通文本，不做整体替换
+        self.secrets = [secret for secret in secrets if secret and len(secret) >= 8]
+
+    def redact(self, text, max_chars=None, keep_tail=False):
+        """:param keep_tail: 超长时保留末尾（异常堆栈最后几行最重要）"""
+        max_chars = max_chars or self.max_chars
+        for secret in self.secrets:
+            text = text.replace(secret, '***')
+        for pattern, replacement in self.SECRET_PATTERNS:
+            text = pattern.sub(replacement, text)
+        text = self.HEX_PATTERN.sub(lambda m: f'<hex {len(m.group(0))} chars>', text)
+        if len(text) > max_chars:
+            if keep_tail:
+                text = f'<truncated {len(text) - max_chars} chars>...{text[-max_chars:]}'
+            else:
+                text = f'{text[:max_chars]}...<truncated {len(text) - max_chars} chars>'
+        return text
+
+    def redact_traceback(self, text):
+        """堆栈先逐行截断，避免异常消息中的大段内容把调用位置挤掉，整体超长时保留末尾"""
+        lines = [self.redact(line, max_chars=max(self.max_chars // 4, 80)) for line in text.split('\n')]
+        return self.redact('\n'.join(lines), keep_tail=True)
+
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        record.job_id = current_job_id.get()
+        try:
+            message = record.getMessage()
+        except Exception as e:
+            message = f'{record.msg!r} (日志参数格式化失败: {e})'
+        record.msg = self.redact(message)
+        record.args = None
+        # 异常堆栈中同样可能有密钥和大段歌词 / 音频数据，格式化为文本后同样处理
+        if record.exc_info:
+            record.exc_text = self.redact_traceback(logging.Formatter().formatException(record.exc_info))
+            record.exc_info = None
+        if record.stack_info:
+            record.stack_info = self.redact_traceback(record.stack_info)
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    默认的 prepare() 会把堆栈并入消息并丢弃 exc_text；消息和堆栈已由 LogContextFilter 处理，
+    这里原样放入队列，由写入线程的格式化器把堆栈单独输出（JSON 格式为 exc_info 字段）
+    """
+
+    def prepare(self, record):
+        return copy.copy(record)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON，便于日志系统按字段检索"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        for field in ('request_id', 'job_id'):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        if record.stack_info:
+            entry['stack_info'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    """
+    用 QueueHandler 替换根日志器的处理器，返回负责实际写入的 QueueListener
+    队列本身不限长度，但队列中的消息都已截断，写入线程只做格式化和磁盘 IO
+    """
+    if LOG_FORMAT == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(job_id)s] %(message)s')
+
+    stream_handler = logging.StreamHandler(sys.stdout)  # 标准输出使用 stdout
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    for handler in (stream_handler, file_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter(secrets=[os.getenv('MINIMAX_API_KEY')]))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    level = logging.getLevelName(LOG_LEVEL)
+    valid_level = isinstance(level, int)
+    if not valid_level:
+        level = logging.INFO
+    root.setLevel(level)
+    # 第三方库的调试日志量很大，只保留警告以上
+    for noisy in ('urllib3', 'asyncio', 'aiohttp'):
+        logging.getLogger(noisy).setLevel(max(level, logging.WARNING))
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    if not valid_level:
+        logging.warning("无效的 LOG_LEVEL: %s，改用 INFO", LOG_LEVEL)
+    return listener
+
+log_listener = configure_logging()
 
 # 创建 Flask 应用
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'downloads'
+# Suno 下载缓存目录及磁盘配额（字节）
+app.config['SUNO_CACHE_DIR'] = os.getenv('SUNO_CACHE_DIR', os.path.join('downloads', 'suno_cache'))
+app.config['SUNO_CACHE_MAX_BYTES'] = int(os.getenv('SUNO_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+# 生成音频的存储目录、总容量配额（字节，0 表示不限）、保留时间（秒，0 表示永久保留）及后台清理间隔（秒）
+app.config['GENERATED_DIR'] = os.getenv('GENERATED_DIR', os.path.join('downloads', 'generated'))
+app.config['GENERATED_MAX_BYTES'] = int(os.getenv('GENERATED_MAX_BYTES', str(10 * 1024 ** 3)))
+app.config['GENERATED_RETENTION_SECONDS'] = int(os.getenv('GENERATED_RETENTION_SECONDS', str(7 * 86400)))
+app.config['STORAGE_SWEEP_INTERVAL'] = float(os.getenv('STORAGE_SWEEP_INTERVAL', '600'))
+# 上传前截取参考音频（off：默认关闭 / auto：安装了 ffmpeg 时启用 / on）、片段长度（秒）、重新编码的采样率和码率
+# 截取会改变提交给生成接口的参考音频，需要显式开启
+app.config['REFERENCE_TRIM'] = os.getenv('REFERENCE_TRIM', 'off').lower()
+app.config['REFERENCE_CLIP_SECONDS'] = float(os.getenv('REFERENCE_CLIP_SECONDS', '30'))
+app.config['REFERENCE_SAMPLE_RATE'] = int(os.getenv('REFERENCE_SAMPLE_RATE', '32000'))
+app.config['REFERENCE_BITRATE'] = os.getenv('REFERENCE_BITRATE', '128k')
+app.config['FFMPEG_PATH'] = os.getenv('FFMPEG_PATH', 'ffmpeg')
+# 歌词润色分块：每块的最大字符数，以及每块结果未通过内容校验时的最多请求次数
+app.config['POLISH_CHUNK_CHARS'] = int(os.getenv('POLISH_CHUNK_CHARS', '400'))
+app.config['POLISH_CHUNK_ATTEMPTS'] = int(os.getenv('POLISH_CHUNK_ATTEMPTS', '3'))
+# 歌词润色方式（llm：调用 Minimax 接口 / local：本地规则 / hedged：接口超过截止时间或失败时改用本地结果）、
+# hedged 模式下等待接口的截止时间（秒），以及本地规则每个短语的最大长度（中日韩字符或单词数）
+app.config['POLISH_MODE'] = os.getenv('POLISH_MODE', 'llm').lower()
+app.config['POLISH_HEDGE_DEADLINE'] = float(os.getenv('POLISH_HEDGE_DEADLINE', '8'))
+app.config['POLISH_LOCAL_MAX_PHRASE'] = int(os.getenv('POLISH_LOCAL_MAX_PHRASE', '12'))
+# 缓存数据库及上传结果有效期（秒），应与 Minimax 服务端的文件保留时间一致
+# 数据库中有用户歌词和上传 ID，不能放在 /audio/ 对外提供的 downloads/ 目录下
+app.config['CACHE_DB_PATH'] = os.getenv('CACHE_DB_PATH', os.path.join('cache', 'cache.db'))
+app.config['UPLOAD_CACHE_TTL'] = int(os.getenv('UPLOAD_CACHE_TTL', '86400'))
+# 共享 HTTP 连接池配置：总连接数、每个主机的连接数、超时与长连接保持时间（秒）
+# 上游服务地址，压测时指向本地的模拟服务（见 benchmark.py）
+app.config['MINIMAX_BASE_URL'] = os.getenv('MINIMAX_BASE_URL', 'https://api.minimax.chat').rstrip('/')
+app.config['SUNO_CDN_URL'] = os.getenv('SUNO_CDN_URL', 'https://cdn1.suno.ai').rstrip('/')
+app.config['HTTP_POOL_SIZE'] = int(os.getenv('HTTP_POOL_SIZE', '100'))
+app.config['HTTP_PER_HOST_LIMIT'] = int(os.getenv('HTTP_PER_HOST_LIMIT', '20'))
+app.config['HTTP_CONNECT_TIMEOUT'] = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+app.config['HTTP_READ_TIMEOUT'] = float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+app.config['HTTP_KEEPALIVE'] = float(os.getenv('HTTP_KEEPALIVE', '60'))
+# Minimax 各接口的限流配置：(每秒请求数, 最大并发数)，并发数会根据 429 / 5xx 自动收缩
+app.config['MINIMAX_RATE_LIMITS'] = {
+    name: (
+        float(os.getenv(f'MINIMAX_{name.upper()}_RPS', str(rate))),
+        int(os.getenv(f'MINIMAX_{name.upper()}_CONCURRENCY', str(concurrency)))
+    )
+    for name, rate, concurrency in [
+        ('upload', 2, 4),
+        ('separate', 2, 4),
+        ('generation', 1, 2),
+        ('chat', 5, 8)
+    ]
+}
+# 失败重试次数及指数退避的基础/最大等待时间（秒）
+app.config['MINIMAX_MAX_RETRIES'] = int(os.getenv('MINIMAX_MAX_RETRIES', '3'))
+app.config['MINIMAX_BACKOFF_BASE'] = float(os.getenv('MINIMAX_BACKOFF_BASE', '1'))
+app.config['MINIMAX_BACKOFF_MAX'] = float(os.getenv('MINIMAX_BACKOFF_MAX', '30'))
+# 歌词润色结果的进程内缓存条数
+app.config['POLISH_CACHE_MAX_ENTRIES'] = int(os.getenv('POLISH_CACHE_MAX_ENTRIES', '1024'))
+# 持久化的润色结果的有效期（秒）和最多保留的条数（0 表示不限），写入新结果时清理过期和超出的旧记录
+app.config['POLISH_CACHE_TTL'] = int(os.getenv('POLISH_CACHE_TTL', str(30 * 24 * 3600)))
+app.config['POLISH_CACHE_MAX_ROWS'] = int(os.getenv('POLISH_CACHE_MAX_ROWS', '100000'))
+# 生成的音频文件内容不会再变化，允许浏览器长期缓存（秒）
+app.config['AUDIO_CACHE_MAX_AGE'] = int(os.getenv('AUDIO_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+# 由前置的 nginx / Apache 通过 X-Sendfile 发送文件
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
+# 后台生成任务配置
+# worker 数量即同时执行的任务数，各阶段的并发数再由 STAGE_LIMIT_* 单独限制；
+# 等待阶段名额的任务同样占用 worker，默认（0）取各阶段并发上限之和，使每个阶段的上限都能用满
+app.config['GENERATE_WORKERS'] = int(os.getenv('GENERATE_WORKERS', '0'))
+app.config['GENERATE_MAX_PENDING'] = int(os.getenv('GENERATE_MAX_PENDING', '100'))
+app.config['JOB_TTL_SECONDS'] = int(os.getenv('JOB_TTL_SECONDS', '3600'))
+# 每个任务保留的最近 SSE 事件数，重连时 Last-Event-ID 早于其中最早事件的客户端改为收到一次完整快照
+app.config['JOB_EVENT_BUFFER'] = int(os.getenv('JOB_EVENT_BUFFER', '500'))
+# 每个任务从提交起的截止时间（秒，请求中的 timeout 不能超过该值），以及 SSE 连接全部断开后等待客户端重连的时间（秒，0 表示不因断开取消任务）
+app.config['JOB_DEADLINE_SECONDS'] = float(os.getenv('JOB_DEADLINE_SECONDS', '600'))
+app.config['DISCONNECT_GRACE_SECONDS'] = float(os.getenv('DISCONNECT_GRACE_SECONDS', '30'))
+# 预取结果的有效期（秒），应小于 UPLOAD_CACHE_TTL
+app.config['PREFETCH_TTL_SECONDS'] = int(os.getenv('PREFETCH_TTL_SECONDS', '900'))
+# 运行记录的租约时间（秒）：执行中的运行超过该时间没有更新时视为所在进程已退出，由其他进程或重启后的进程接管
+app.config['RUN_LEASE_SECONDS'] = float(os.getenv('RUN_LEASE_SECONDS', '60'))
+app.config['STAGE_LIMITS'] = {
+    'downloading': int(os.getenv('STAGE_LIMIT_DOWNLOAD', '16')),
+    'polishing': int(os.getenv('STAGE_LIMIT_POLISH', '8')),
+    'uploading': int(os.getenv('STAGE_LIMIT_UPLOAD', '4')),
+    'generating': int(os.getenv('STAGE_LIMIT_GENERATE', '2'))
+}
+if app.config['GENERATE_WORKERS'] <= 0:
+    app.config['GENERATE_WORKERS'] = sum(app.config['STAGE_LIMITS'].values())
+app.config['BATCH_MAX_ITEMS'] = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+# 生产 ASGI 模式：worker 进程数、监听地址，以及关闭时等待进行中任务完成的最长时间（秒）
+app.config['ASGI_WORKERS'] = int(os.getenv('ASGI_WORKERS', '0'))
+app.config['HOST'] = os.getenv('HOST', '127.0.0.1')
+app.config['PORT'] = int(os.getenv('PORT', '5000'))
+app.config['SHUTDOWN_DRAIN_TIMEOUT'] = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '30'))
+# ASGI 模式下每个 worker 进程执行 Flask 请求的线程数，即可同时处理（含正在下载音频）的普通请求数
+app.config['ASGI_THREADS'] = int(os.getenv('ASGI_THREADS', '64'))
+
+class Metrics:
+    """
+    进程内指标注册表，以 Prometheus 文本格式导出
+    支持计数器、仪表盘和直方图；采集时才能计算的值（缓存命中率、限流器状态等）通过 collector 在导出前更新
+    """
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
 
-class MusicGenerator:
     def __init__(self):
-        """
-        初始化音乐生成器
-        """
-        self.api_key = os.getenv('MINIMAX_API_KEY')
-        if not self.api_key:
-            raise ValueError("Missing MINIMAX_API_KEY in environment variables")
-            
-        self.upload_url = "https://api.minimax.chat/v1/music_upload"
-        self.generation_url = "https://api.minimax.chat/v1/music_generation"
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        logging.info("MusicGenerator initialized")
+        self._lock = threading.Lock()
+        self._meta = {}  # 指标名 -> (类型, 说明)
+        self._values = defaultdict(float)  # (指标名, 标签) -> 值
+        self._histograms = {}  # (指标名, 标签) -> [各桶计数..., 总和, 次数]
+        self._collectors = []
 
-    def upload_file(self, file_path, timeout=60, max_retries=3):
-        """
-        上传音频文件
-        :param file_path: 音频文件路径
-        :param timeout: 请求超时时间（秒）
-        :param max_retries: 最大重试次数
-        :return: 上传后的文件ID
-        """
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                if not os.path.exists(file_path):
-                    logging.error(f"文件不存在: {file_path}")
-                    return None
+    def describe(self, name, metric_type, help_text):
+        self._meta[name] = (metric_type, help_text)
 
-                # 获取文件的MIME类型
-                mime_type = mimetypes.guess_type(file_path)[0] or 'audio/mpeg'
-                
-                # 构建multipart/form-data请求
-                payload = {
-                    'purpose': 'song'  # 设置purpose为song
-                }
-                
-                files = [
-                    ('file', (
-                        os.path.basename(file_path), 
-                        open(file_path, 'rb'), 
-                        mime_type
-                    ))
-                ]
-                
-                logging.info(f"开始上传文件（第{retry_count + 1}次尝试）: {os.path.basename(file_path)}")
-                
-                response = requests.post(
-                    self.upload_url,
-                    headers={
-                        'Authorization': f"Bearer {self.api_key}"
-                    },
-                    data=payload,
-                    files=files,
-                    timeout=timeout  # 增加超时时间
-                )
-                
-                response.raise_for_status()
-                result = response.json()
-                logging.info(f"上传响应数据: {json.dumps(result, indent=2)}")
-                
-                if result.get('base_resp', {}).get('status_code') == 0:
-                    return result
-                else:
-                    logging.error(f"上传失败响应: {result}")
-                    return None
-                
-            except requests.exceptions.Timeout:
-                retry_count += 1
-                if retry_count < max_retries:
-                    logging.warning(f"上传超时，正在进行第{retry_count + 1}次重试...")
-                    continue
-                else:
-                    logging.error("上传多次超时，放弃重试")
-                    return None
-                    
-            except requests.exceptions.RequestException as e:
-                logging.error(f"上传请求失败: {str(e)}")
-                return None
-            except Exception as e:
-                logging.error(f"上传文件时发生错误: {str(e)}")
-                return None
-            finally:
-                # 确保文件被关闭
-                if 'files' in locals() and files[0][1][1]:
-                    files[0][1][1].close()
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
 
-    def separate_audio(self, file_path):
-        """
-        分离音频文件为人声和伴奏
-        :param file_path: 音频文件路径
-        :return: (voice_id, instrumental_id) 元组
-        """
-        try:
-            logging.info(f"开始分离音频: {os.path.basename(file_path)}")
-            
-            # 上传原始文件
-            file_id = self.upload_file(file_path)
-            if not file_id:
-                return None, None
-            
-            # 调用分离API
-            separate_url = f"{self.upload_url}/separate"
-            payload = {"file_id": file_id}
-            
-            response = requests.post(
-                separate_url,
-                headers=self.headers,
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            if result.get("status") == "success":
-                voice_id = result.get("voice_id")
-                instrumental_id = result.get("instrumental_id")
-                logging.info(f"音频分离成功 - 人声ID: {voice_id}, 伴奏ID: {instrumental_id}")
-                return voice_id, instrumental_id
-            else:
-                raise Exception(f"分离失败: {result.get('message')}")
-                
-        except Exception as e:
-            logging.error(f"分离音频时发生错误: {str(e)}")
-            return None, None
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._values[(name, self._labels(labels))] += value
 
-    def generate_music(self, prompt=None, style="classical", duration=30, voice_path=None, instrumental_path=None, lyrics=None):
-        try:
-            logging.info("=== 开始生成音乐 ===")
-            logging.info(f"音频文件路径: {voice_path}")
-            logging.info(f"歌词内容: {lyrics}")
-            
-            voice_id = None  # 初始化变量
-            instrumental_id = None  # 初始化变量
-            
-            if voice_path:
-                logging.info("开始上传音频文件...")
-                upload_response = self.upload_file(voice_path)
-                logging.info(f"上传响应: {json.dumps(upload_response, indent=2)}")
-                
-                if isinstance(upload_response, dict):
-                    voice_id = upload_response.get('voice_id', '')
-                    instrumental_id = upload_response.get('instrumental_id', '')
-                    logging.info(f"上传成功 - voice_id: {voice_id}, instrumental_id: {instrumental_id}")
-                else:
-                    logging.error("上传失败，无法获取音频ID")
-                    return None
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, self._labels(labels))] = value
 
-            # 在歌词前后添加 ##
-            if lyrics:
-                lyrics = f"##\n{lyrics}\n##"
+    def value(self, name, **labels):
+        with self._lock:
+            return self._values.get((name, self._labels(labels)), 0)
 
-            # 构建请求参数
-            payload = {
-                'refer_voice': voice_id if voice_id else "",
-                'refer_instrumental': instrumental_id if instrumental_id else "",
-                'lyrics': lyrics if lyrics else "",
-                'model': 'music-01',
-                'audio_setting': '{"sample_rate":44100,"bitrate":256000,"format":"mp3"}'
-            }
-            
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(self.DEFAULT_BUCKETS) + [0.0, 0]
+            for index, bound in enumerate(self.DEFAULT_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def add_collector(self, collector):
+        """collector() 在每次导出前调用，用于刷新仪表盘类指标"""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+            for key, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        for collector in self._collectors:
             try:
-                logging.info("开始生成音乐...")
-                logging.info(f"生成请求数据: {json.dumps(payload, indent=2)}")
-                
-                response = requests.post(
-                    self.generation_url,
-                    headers={
-                        'Authorization': f"Bearer {self.api_key}",
-                        'Content-Type': 'application/x-www-form-urlencoded'
-                    },
-                    data=payload,
-                    timeout=60
-                )
-                
-                logging.info(f"响应状态码: {response.status_code}")
-                logging.info(f"响应内容: {response.text}")
-                
-                if response.status_code == 200:
-                    try:
-                        # 尝试解析响应内容
-                        response_text = response.text.strip()  # 移除可能的��白字符
-                        if response_text:
-                            result = json.loads(response_text)
-                            if result and result.get("data") and result["data"].get("audio"):
-                                # 使用 app.config['UPLOAD_FOLDER'] 作为保存目录
-                                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                output_file = os.path.join(app.config['UPLOAD_FOLDER'], f'generated_music_{timestamp}.mp3')
-                                
-                                # 确保目录存在
-                                os.makedirs(os.path.dirname(output_file), exist_ok=True)
-                                
-                                # 解码音频数据
-                                audio_data = bytes.fromhex(result["data"]["audio"])
-                                with open(output_file, "wb") as f:
-                                    f.write(audio_data)
-                                
-                                logging.info(f"音乐生成成功，保存为: {output_file}")
-                                return output_file
-                            else:
-                                error_msg = result.get('base_resp', {}).get('status_msg', '未知错误')
-                                raise Exception(f"生成失败: {error_msg}")
-                        else:
-                            raise Exception("响应内容为空")
-                    except json.JSONDecodeError as e:
-                        logging.error(f"JSON解析错误: {str(e)}")
-                        logging.error(f"原始响应内容: {response.text}")
-                        raise Exception("响应格式错误")
-                else:
-                    raise Exception(f"请求失败: HTTP {response.status_code}")
-                
+                collector()
             except Exception as e:
-                logging.error(f"生成音乐时发生错误: {str(e)}")
-                return None
+                logging.warning("指标采集失败: %s", str(e))
 
-        except Exception as e:
-            logging.error("=== 生成音乐时发生错误 ===")
-            logging.error(f"错误类型: {type(e)}")
-            logging.error(f"错误信息: {str(e)}")
-            logging.error("详细堆栈:", exc_info=True)
-            return None
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
 
-    async def download_suno_audio(self, suno_url, output_dir='downloads'):
-        """异步下载 Suno 音频文件"""
-        try:
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            
-            logging.info("开始下载Suno音频: %s", suno_url)
-            
-            # 从URL中提取音频ID
-            song_id = suno_url.split('/')[-1]
-            # 构建实际的音频URL
-            audio_url = f"https://cdn1.suno.ai/{song_id}.mp3"
-            
-            # 更新请求头，模拟真实浏览器请求
-            headers = {
-                'Accept-Encoding': 'identity;q=1, *;q=0',
-                'Referer': 'https://suno.com/',
-                'User-Agent': 'Mozilla/5.0 (Linux; Android) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.109 Safari/537.36 CrKey/1.54.248666'
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.get(audio_url, headers=headers) as response:
-                    if response.status == 200:
-                        output_file = os.path.join(output_dir, f'suno_{song_id}.mp3')
-                        with open(output_file, 'wb') as f:
-                            while True:
-                                chunk = await response.content.read(8192)
-                                if not chunk:
-                                    break
-                                f.write(chunk)
-                        logging.info("Suno音频下载成功: %s", output_file)
-                        return output_file
-                    else:
-                        logging.error("下载失败，状态码: %d", response.status)
-                        return None
-                    
-        except Exception as e:
-            logging.error("下载Suno音频时发生错误: %s", str(e))
-            return None
+        by_name = defaultdict(list)
+        for (name, labels), value in values.items():
+            by_name[name].append((labels, value))
+        for (name, labels), value in histograms.items():
+            by_name[name].append((labels, value))
 
-    def generate_from_suno(self, suno_url, prompt=None, style="classical", duration=30):
-        try:
-            # 使用同步方式下载
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            downloaded_file = loop.run_until_complete(self.download_suno_audio(suno_url))
-            loop.close()
-            
-            if not downloaded_file:
-                logging.error("Suno音频下载失败")
-                return None
-            
-            logging.info(f"Suno音频下载成功: {downloaded_file}")
-            
-            # 2. 使用下载的音频生成新的音频
-            output_file = self.generate_music(
-                prompt=prompt or "基于上传的音频创作一段优美的音乐，保持原曲风格",
-                style=style,
-                duration=duration,
-                voice_path=downloaded_file
-            )
-            
-            if output_file:
-                logging.info(f"基于Suno音频生成新音频成功: {output_file}")
-            else:
-                logging.error("基于Suno音频生成新音频失败")
-            
-            return output_file
-            
-        except Exception as e:
-            logging.error(f"从Suno音频生成新音频时发生错误: {str(e)}")
-            return None
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text = self._meta.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if metric_type == 'histogram':
+                    for index, bound in enumerate(self.DEFAULT_BUCKETS):
+                        lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {value[index]}')
+                    lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {value[-1]}')
+                    lines.append(f'{name}_sum{self._format_labels(labels)} {value[-2]}')
+                    lines.append(f'{name}_count{self._format_labels(labels)} {value[-1]}')
+                else:
+                    lines.append(f'{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
 
-class LyricsPolisher:
-    def __init__(self):
-        self.api_key = os.getenv('MINIMAX_API_KEY')
-        self.group_id = os.getenv('MINIMAX_GROUP_ID')
-        if not self.api_key or not self.group_id:
-            raise ValueError("Missing required environment variables")
-        self.url = "https://api.minimax.chat/v1/text/chatcompletion_v2"
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "mm-group-id": self.group_id
-        }
-        logging.info("LyricsPolisher initialized")
-    
-    async def polish_lyrics(self, original_lyrics):
-        """使用 Minimax API 异步润色歌词"""
-        try:
-            logging.info("开始润色歌词: %s", repr(original_lyrics))
-            
-            # 构建更清晰的 system prompt
-            system_prompt = """你是一个专业的语义节奏大师。你的任务是：
-1. 分析输入歌词语义
-2. 仅通过添加换行符来添加节奏和停顿：
-   - 使用双换行符"\n"表示短停顿
-   - 使用双换行符"\n\n"表示长停顿
-3. 不要修改任何原始歌词内容
-4. 不要添加任何其他标点或符号
-5. 不要添加任何额外说明或注释"""
 
-            payload = {
-                "model": "abab5.5-chat",
-                "stream": False,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": original_lyrics
-                    }
-                ],
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "max_tokens": 2000,  # 增加 token 限制以适应更长的歌词
-                "echo": False 
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.url, headers=self.headers, json=payload) as response:
-                    response_text = await response.text()
-                    logging.info("API 响应内容: %s", response_text)
-                    
-                    if response.status != 200:
-                        logging.error("API 请求失败，状态码: %d", response.status)
-                        return None
-                    
-                    result = json.loads(response_text)
-                    
-                    # 检查响应状态
-                    if result.get("base_resp", {}).get("status_code") != 0:
-                        error_msg = result.get("base_resp", {}).get("status_msg", "未知错误")
-                        logging.error("API 返回错误: %s", error_msg)
-                        return None
-                    
-                    # 获取润色后的歌词
-                    if "choices" in result and len(result["choices"]) > 0:
-                        # 获取润��后的歌词并去除首尾空白字符
-                        polished_lyrics = result["choices"][0]["message"]["content"].strip()
-                        
-                        # 直接在歌词前添加##，不添加任何换行符
-                        final_lyrics = f"##" + polished_lyrics + "##"
-                        
-                        # 记录处理结果
-                        logging.info("润色后的歌词 (原始格式):\n%s", repr(final_lyrics))
-                        logging.info("润色后的歌词 (显示格式):\n%s", final_lyrics)
-                        
-                        return final_lyrics
-                    else:
-                        logging.error("响应中没有找到歌词内容")
-                        return None
-            
-        except Exception as e:
-            logging.error("歌词润色过程中发生错误: %s", str(e))
-            return None
+metrics = Metrics()
+metrics.describe('music_stage_duration_seconds', 'histogram', '各阶段耗时')
+metrics.describe('music_stage_calls_total', 'counter', '各阶段调用次数，按结果分类')
+metrics.describe('music_stage_in_flight', 'gauge', '各阶段正在执行的调用数')
+metrics.describe('music_bytes_total', 'counter', '各阶段传输的字节数')
+metrics.describe('music_cache_hits_total', 'counter', '缓存命中次数')
+metrics.describe('music_cache_misses_total', 'counter', '缓存未命中次数')
+metrics.describe('music_cache_hit_ratio', 'gauge', '缓存命中率')
+metrics.describe('music_upstream_requests_total', 'counter', 'Minimax 各接口请求次数（含重试）')
+metrics.describe('music_upstream_retries_total', 'counter', 'Minimax 各接口重试次数')
+metrics.describe('music_upstream_throttled_total', 'counter', 'Minimax 各接口被限流次数')
+metrics.describe('music_upstream_concurrency_limit', 'gauge', 'Minimax 各接口当前的自适应并发上限')
+metrics.describe('music_upstream_in_flight', 'gauge', 'Minimax 各接口正在进行的请求数')
+metrics.describe('music_jobs', 'gauge', '各状态的生成任务数')
+metrics.describe('music_polish_rejected_total', 'counter', '改动了歌词内容而被重新请求的润色结果数')
+metrics.describe('music_prefetch_total', 'counter', '预取请求数（started：新开始 / reused：复用有效期内的预取）')
+metrics.describe('music_jobs_cancelled_total', 'counter', '超过截止时间或客户端断开而取消的任务数（按原因）')
+metrics.describe('music_polish_fallback_total', 'counter', 'hedged 模式下改用本地润色结果的次数（按原因）')
+metrics.describe('music_reference_bytes_saved_total', 'counter', '截取参考音频减少的上传字节数')
+metrics.describe('music_storage_bytes', 'gauge', '生成音频存储的总大小（上次清理时统计）')
+metrics.describe('music_storage_files', 'gauge', '生成音频存储的文件数（上次清理时统计）')
+metrics.describe('music_single_flight_coalesced_total', 'counter', '被合并到进行中调用的请求数')
 
-# 添加路由处理
-@app.route('/')
-def index():
-    return send_from_directory('static', 'index.html')
 
-@app.route('/api/generate', methods=['POST'])
-async def generate():
-    try:
-        logging.info("收到生成请求")
-        data = request.json
-        logging.info(f"请求数据: {json.dumps(data, ensure_ascii=False)}")
-        
-        suno_url = data.get('suno_url')
-        original_lyrics = data.get('lyrics')
+def instrumented(stage, succeeded=lambda result: result is not None):
+    """
+    记录函数调用耗时、进行中的调用数和结果的装饰器，同时支持普通函数和协程函数
+    :param stage: 阶段名，作为 stage 标签
+    :param succeeded: 根据返回值判断调用是否成功（本项目的函数失败时返回 None）
+    """
+    def record(started, outcome):
+        metrics.observe('music_stage_duration_seconds', time.monotonic() - started, stage=stage)
+        metrics.inc('music_stage_calls_total', stage=stage, outcome=outcome)
+        metrics.inc('music_stage_in_flight', -1, stage=stage)
 
-        if not suno_url or not original_lyrics:
-            logging.error("缺少必要参数")
-            return jsonify({
-                'success': False,
-                'message': '请供完整的参数'
-            }), 400
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                metrics.inc('music_stage_in_flight', 1, stage=stage)
+                started = time.monotonic()
+                outcome = 'error'
+                try:
+                    result = await func(*args, **kwargs)
+                    outcome = 'success' if succeeded(result) else 'failure'
+                    return result
+                finally:
+                    record(started, outcome)
+            return async_wrapper
 
-        try:
-            # 直接创建实例，不传入 api_key
-            generator = MusicGenerator()
-            polisher = LyricsPolisher()
-            
-            # 1. 下载音频
-            logging.info("开始下载音频")
-            downloaded_file = await generator.download_suno_audio(suno_url)
-            if not downloaded_file:
-                logging.error("音频下载失败")
-                return jsonify({
-                    'success': False,
-                    'message': '音频下载失败'
-                }), 500
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics.inc('music_stage_in_flight', 1, stage=stage)
+            started = time.monotonic()
+            outcome = 'error'
+            try:
+                result = func(*args, **kwargs)
+                outcome = 'success' if succeeded(result) else 'failure'
+                return result
+            finally:
+                record(started, outcome)
+        return wrapper
+    return decorator
 
-            logging.info(f"音频下载成功: {downloaded_file}")
 
-            # 2. 润色歌词
-            logging.info("开始润色歌词")
-            polished_lyrics = await polisher.polish_lyrics(original_lyrics)
-            if not polished_lyrics:
-                logging.error("歌词润色失败")
-                return jsonify({
-                    'success': False,
-                    'message': '歌词润色失败'
-                }), 500
-            logging.info(f"歌词润色成功: {polished_lyrics}")
-
-            # 3. 生成音乐，使用润色后的歌词
-            logging.info("开始生成音乐")
-            output_file = generator.generate_music(
-                voice_path=downloaded_file,
-                lyrics=polished_lyrics  # 使用润色后的歌词
-            )
+class DeadlineExceeded(Exception):
+    """任务超过截止时间或已被取消"""
 
-            if not output_file:
-                logging.error("音乐生成失败")
-                return jsonify({
-                    'success': False,
-                    'message': '音乐生成失败'
-                }), 500
 
-            # 返回结果
-            audio_url = f'/audio/{os.path.basename(output_file)}'
-            return jsonify({
-                'success': True,
-                'audio_url': audio_url,
-                'polished_lyrics': polished_lyrics  # 返回润色后的歌词
-            })
+class Deadline:
+    """
+    一个任务的截止时间，通过 current_deadline 传递给各阶段，每次上游调用只使用剩余的时间
+    同时作为取消标记：cancel() 之后 check() 立即失败，线程池中的阻塞调用在下一个检查点退出
+    """
 
-        except Exception as task_error:
-            logging.error(f"任务执行过程中发生错误: {str(task_error)}")
-            logging.error(f"错误类型: {type(task_error)}")
-            logging.error(f"错误详情: ", exc_info=True)
-            raise task_error
+    def __init__(self, seconds=None, expires_at=None):
+        self.expires_at = expires_at if expires_at is not None else time.monotonic() + seconds
+        self.cancel_reason = None
 
-    except Exception as e:
-        logging.error(f"处理请求时发生错误: {str(e)}")
-        logging.error("完整错误信息: ", exc_info=True)
-        return jsonify({
-            'success': False,
-            'message': f"错误: {str(e)}"
-        }), 500
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
 
-@app.route('/audio/<filename>')
-def serve_audio(filename):
-    """提供音频文件下载"""
-    try:
-        return send_file(
-            os.path.join(app.config['UPLOAD_FOLDER'], filename),
-            mimetype='audio/mpeg',
-            as_attachment=True,
-            download_name=filename
-        )
-    except Exception as e:
+    @property
+    def expired(self):
+        return self.cancel_reason is not None or self.remaining() <= 0
+
+    def cancel(self, reason):
+        self.cancel_reason = reason
+
+    def check(self):
+        if self.cancel_reason is not None:
+            raise DeadlineExceeded(self.cancel_reason)
+        if self.remaining() <= 0:
+            raise DeadlineExceeded('任务超过截止时间，已取消')
+
+    def timeout(self, default=None):
+        """本次调用可用的超时时间（秒）：不超过剩余时间，已超时或已取消时抛出 DeadlineExceeded"""
+        self.check()
+        remaining = self.remaining()
+        return remaining if default is None else min(default, remaining)
+
+    def extend(self, expires_at):
+        """把截止时间推迟到 expires_at（不会提前），用于有新的任务加入共享的调用"""
+        self.expires_at = max(self.expires_at, expires_at)
+
+
+# 当前任务的截止时间，由 JobManager 在执行任务时设置，线程池中的调用通过复制的上下文继承
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class HttpClient:
+    """
+    进程内共享的 HTTP 客户端
+    同步调用使用带连接池的 requests.Session，异步调用使用任务事件循环上的 aiohttp.ClientSession，
+    两者都复用长连接并限制每个主机的并发连接数，避免每次请求重新进行 DNS / TCP / TLS 握手
+    """
+
+    def __init__(self, pool_size=100, per_host_limit=20, connect_timeout=10, read_timeout=60, keepalive=60):
+        self.pool_size = pool_size
+        self.per_host_limit = per_host_limit
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=per_host_limit, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapter = adapter
+
+        self._aio_session = None
+        self._aio_loop = None
+        self._lock = threading.Lock()
+        self._aio_stats = defaultdict(lambda: defaultdict(int))  # 主机 -> 计数
+
+    def aiohttp_session(self):
+        """
+        获取共享的 aiohttp 会话，首次调用时在当前事件循环上创建
+        会话与创建它的事件循环绑定，只能在任务事件循环中使用
+        """
+        loop = asyncio.get_running_loop()
+        if self._aio_session is None or self._aio_session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_config.on_request_end.append(self._on_request_end)
+            trace_config.on_request_exception.append(self._on_request_end)
+            trace_config.on_connection_create_end.append(self._on_connection_create)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.per_host_limit,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300
+            )
+            self._aio_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                trace_configs=[trace_config]
+            )
+            self._aio_loop = loop
+        elif self._aio_loop is not loop:
+            raise RuntimeError("共享的 aiohttp 会话只能在任务事件循环中使用")
+        return self._aio_session
+
+    def request_timeout(self, timeout=None):
+        """requests 的 (连接, 读取) 超时，当前任务有截止时间时均不超过剩余时间"""
+        timeout = timeout or self.timeout
+        deadline = current_deadline.get()
+        if deadline is None:
+            return timeout
+        if isinstance(timeout, tuple):
+            return tuple(deadline.timeout(value) for value in timeout)
+        return deadline.timeout(timeout)
+
+    def aiohttp_timeout(self):
+        """aiohttp 请求的超时，当前任务有截止时间时整个请求（含读取响应体）不超过剩余时间"""
+        deadline = current_deadline.get()
+        return aiohttp.ClientTimeout(
+            total=deadline.timeout() if deadline else None,
+            sock_connect=self.connect_timeout,
+            sock_read=self.read_timeout
+        )
+
+    async def _on_request_start(self, session, context, params):
+        with self._lock:
+            stats = self._aio_stats[params.url.host]
+            stats['requests'] += 1
+            stats['in_flight'] += 1
+
+    async def _on_request_end(self, session, context, params):
+        with self._lock:
+            self._aio_stats[params.url.host]['in_flight'] -= 1
+
+    async def _on_connection_create(self, session, context, params):
+        with self._lock:
+            self._aio_stats['*']['connections_created'] += 1
+
+    async def _on_connection_reuse(self, session, context, params):
+        with self._lock:
+            self._aio_stats['*']['connections_reused'] += 1
+
+    async def close_async(self):
+        """关闭 aiohttp 会话，需在任务事件循环中调用"""
+        if self._aio_session is not None and not self._aio_session.closed:
+            await self._aio_session.close()
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        """连接池统计信息，用于确定连接池大小"""
+        sync_pools = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            sync_pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'connections_created': pool.num_connections,
+                'requests': pool.num_requests,
+                # 连接池队列中预先填充了 None 占位，只统计真实的空闲连接
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn) if pool.pool else 0
+            }
+
+        with self._lock:
+            async_stats = {host: dict(values) for host, values in self._aio_stats.items()}
+        if self._aio_session is not None and not self._aio_session.closed:
+            async_stats.setdefault('*', {})['limit'] = self.pool_size
+            async_stats['*']['limit_per_host'] = self.per_host_limit
+
+        return {
+            'sync': sync_pools,
+            'async': async_stats,
+            'timeout': {'connect': self.connect_timeout, 'read': self.read_timeout}
+        }
+
+
+http_client = HttpClient(
+    pool_size=app.config['HTTP_POOL_SIZE'],
+    per_host_limit=app.config['HTTP_PER_HOST_LIMIT'],
+    connect_timeout=app.config['HTTP_CONNECT_TIMEOUT'],
+    read_timeout=app.config['HTTP_READ_TIMEOUT'],
+    keepalive=app.config['HTTP_KEEPALIVE']
+)
+
+class RetryableError(Exception):
+    """可重试的上游错误；throttled 表示被限流或服务端过载（429、5xx 或限流错误码），需要收缩并发，retry_after 为服务端建议的等待秒数"""
+
+    def __init__(self, message, throttled=False, retry_after=None):
+        super().__init__(message)
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+
+# Minimax 在 HTTP 200 响应中通过 base_resp.status_code 返回的限流错误码
+MINIMAX_RATE_LIMIT_CODES = {1002, 1039}
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或 HTTP 日期），无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def check_retryable_status(status, headers):
+    """429 和 5xx 响应抛出 RetryableError，都视为需要收缩并发（500 / 502 / 504 同样说明上游过载）"""
+    if status == 429 or status >= 500:
+        raise RetryableError(
+            f"HTTP {status}",
+            throttled=True,
+            retry_after=parse_retry_after(headers.get('Retry-After'))
+        )
+
+
+def check_minimax_base_resp(result):
+    """base_resp 中的限流错误码抛出 RetryableError"""
+    status_code = (result or {}).get('base_resp', {}).get('status_code')
+    if status_code in MINIMAX_RATE_LIMIT_CODES:
+        raise RetryableError(
+            f"触发限流: {result['base_resp'].get('status_msg', status_code)}",
+            throttled=True
+        )
+
+
+def is_transient_error(error):
+    """超时和连接错误视为可重试"""
+    return isinstance(error, (
+        requests.exceptions.Timeout,
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+        aiohttp.ClientPayloadError,
+        asyncio.TimeoutError
+    ))
+
+
+class AdaptiveRateLimiter:
+    """
+    单个上游接口的限流器
+    令牌桶限制请求速率；并发上限按 AIMD 自适应调整：被限流或 5xx 时减半，成功时缓慢增加；
+    收到 Retry-After 时该接口的所有请求都等待到指定时间之后
+    """
+
+    def __init__(self, name, rate, max_concurrency):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, float(max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.retries = 0
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        """尝试获取一个请求名额，成功返回 0，否则返回建议的等待秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self.in_flight >= int(self.limit):
+                return 0.05
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+            self.in_flight += 1
+            self.requests += 1
+            return 0
+
+    def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, outcome, retry_after=None):
+        """
+        归还名额并根据结果调整并发上限
+        :param outcome: success / throttled / error
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if outcome == 'success':
+                # 加性增：大约每成功 limit 次并发上限加 1
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif outcome == 'throttled':
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.errors += 1
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'concurrency_limit': round(self.limit, 2),
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'retries': self.retries
+            }
+
+
+minimax_limiters = {
+    name: AdaptiveRateLimiter(name, rate, concurrency)
+    for name, (rate, concurrency) in app.config['MINIMAX_RATE_LIMITS'].items()
+}
+
+
+def backoff_delay(attempt, retry_after=None):
+    """指数退避加全随机抖动，服务端给出 Retry-After 时至少等待该时间"""
+    delay = random.uniform(0, min(app.config['MINIMAX_BACKOFF_MAX'], app.config['MINIMAX_BACKOFF_BASE'] * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _classify_failure(error):
+    """返回 (outcome, retry_after)，不可重试的错误返回 (None, None)"""
+    if isinstance(error, RetryableError):
+        return ('throttled' if error.throttled else 'error'), error.retry_after
+    if is_transient_error(error):
+        return 'error', None
+    return None, None
+
+
+def call_with_retry(endpoint, func, max_retries=None):
+    """
+    经限流器调用 Minimax 接口（同步），可重试的错误按指数退避重试
+    :param endpoint: minimax_limiters 中的接口名
+    :param func: 发起一次请求的函数，遇到可重试的错误时抛出 RetryableError
+    """
+    limiter = minimax_limiters[endpoint]
+    if max_retries is None:
+        max_retries = app.config['MINIMAX_MAX_RETRIES']
+    deadline = current_deadline.get()
+    attempt = 0
+    while True:
+        if deadline:
+            deadline.check()
+        limiter.acquire()
+        try:
+            result = func()
+        except Exception as e:
+            outcome, retry_after = _classify_failure(e)
+            limiter.release(outcome or 'error', retry_after)
+            if outcome is None or attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, retry_after)
+            if deadline and delay >= deadline.remaining():
+                # 等不到下一次重试就会超过截止时间
+                raise
+            logging.warning("%s 请求失败（%s），%.1f 秒后第 %d 次重试", endpoint, str(e), delay, attempt + 1)
+            limiter.record_retry()
+            attempt += 1
+            time.sleep(delay)
+            continue
+        limiter.release('success')
+        return result
+
+
+async def call_with_retry_async(endpoint, coro_func, max_retries=None):
+    """call_with_retry 的异步版本，coro_func 为无参协程函数"""
+    limiter = minimax_limiters[endpoint]
+    if max_retries is None:
+        max_retries = app.config['MINIMAX_MAX_RETRIES']
+    deadline = current_deadline.get()
+    attempt = 0
+    while True:
+        if deadline:
+            deadline.check()
+        await limiter.acquire_async()
+        try:
+            result = await coro_func()
+        except asyncio.CancelledError:
+            limiter.release('error')
+            raise
+        except Exception as e:
+            outcome, retry_after = _classify_failure(e)
+            limiter.release(outcome or 'error', retry_after)
+            if outcome is None or attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, retry_after)
+            if deadline and delay >= deadline.remaining():
+                raise
+            logging.warning("%s 请求失败（%s），%.1f 秒后第 %d 次重试", endpoint, str(e), delay, attempt + 1)
+            limiter.record_retry()
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        limiter.release('success')
+        return result
+
+
+def extract_suno_song_id(suno_url):
+    """从 Suno 链接中提取歌曲 ID，格式不合法时返回 None"""
+    song_id = suno_url.split('?')[0].split('#')[0].rstrip('/').split('/')[-1]
+    if not re.fullmatch(r'[0-9A-Za-z_-]+', song_id):
+        return None
+    return song_id
+
+
+class SunoDownloadCache:
+    """
+    Suno 音频的磁盘缓存，以歌曲 ID 为键
+    索引保存在缓存数据库（SQLite）中，记录每个文件的大小、最后访问时间和 sha256 校验值，多个 worker 进程共用同一份索引；
+    总大小超过配额时按最近最少使用淘汰；文件先写入临时文件再原子重命名，并发请求不会读到写了一半的文件
+    """
+    LEGACY_INDEX_FILE = 'index.json'  # 旧版本保存在缓存目录中的索引，首次使用时导入数据库
+
+    def __init__(self, cache_dir, max_bytes, db_path):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self._initialized = False
+
+    def path_for(self, song_id):
+        # 按歌曲 ID 的哈希前缀分子目录存放，避免单个目录中的文件过多
+        shard = hashlib.md5(song_id.encode()).hexdigest()[:2]
+        return os.path.join(self.cache_dir, shard, f'suno_{song_id}.mp3')
+
+    def _connect(self):
+        conn = connect_cache_db(self.db_path)
+        if not self._initialized:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS download_cache ('
+                    'song_id TEXT PRIMARY KEY, '
+                    'size INTEGER NOT NULL, '
+                    'last_access REAL NOT NULL, '
+                    'sha256 TEXT NOT NULL)'
+                )
+                self._import_legacy_index(conn)
+            self._initialized = True
+        return conn
+
+    def _import_legacy_index(self, conn):
+        """导入旧版本的 index.json 索引后删除该文件（调用方需在事务中）"""
+        index_path = os.path.join(self.cache_dir, self.LEGACY_INDEX_FILE)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (ValueError, OSError) as e:
+            logging.warning("旧版下载缓存索引损坏，已忽略: %s", str(e))
+            index = {}
+        conn.executemany(
+            'INSERT OR IGNORE INTO download_cache (song_id, size, last_access, sha256) VALUES (?, ?, ?, ?)',
+            [(song_id, entry['size'], entry['last_access'], entry['sha256']) for song_id, entry in index.items()]
+        )
+        try:
+            os.remove(index_path)
+        except FileNotFoundError:
+            # 其他进程已经导入
+            pass
+        logging.info("已导入旧版下载缓存索引: %d 条", len(index))
+
+    def get(self, song_id):
+        """
+        查找缓存
+        :return: 缓存文件路径，未命中时返回 None
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT size FROM download_cache WHERE song_id = ?', (song_id,)).fetchone()
+            if not row:
+                metrics.inc('music_cache_misses_total', cache='download')
+                return None
+            path = self.path_for(song_id)
+            legacy_path = os.path.join(self.cache_dir, f'suno_{song_id}.mp3')
+            if not os.path.exists(path) and os.path.exists(legacy_path):
+                # 旧版本平铺存放的缓存文件，移动到分片目录
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.replace(legacy_path, path)
+                except FileNotFoundError:
+                    # 其他进程或线程已经移动
+                    pass
+            if not os.path.exists(path) or os.path.getsize(path) != row[0]:
+                logging.warning("下载缓存文件缺失或大小不符，丢弃缓存: %s", song_id)
+                with conn:
+                    conn.execute('DELETE FROM download_cache WHERE song_id = ?', (song_id,))
+                metrics.inc('music_cache_misses_total', cache='download')
+                return None
+            with conn:
+                conn.execute('UPDATE download_cache SET last_access = ? WHERE song_id = ?', (time.time(), song_id))
+        metrics.inc('music_cache_hits_total', cache='download')
+        return path
+
+    def checksum(self, song_id):
+        """返回缓存文件的 sha256，未缓存时返回 None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT sha256 FROM download_cache WHERE song_id = ?', (song_id,)).fetchone()
+        return row[0] if row else None
+
+    def checksum_for_file(self, file_path):
+        """如果文件是本缓存中的文件，返回索引中记录的 sha256，否则返回 None"""
+        match = re.fullmatch(r'suno_([0-9A-Za-z_-]+)\.mp3', os.path.basename(file_path))
+        if not match or os.path.abspath(file_path) != os.path.abspath(self.path_for(match.group(1))):
+            return None
+        return self.checksum(match.group(1))
+
+    def create_temp_file(self):
+        """
+        在缓存目录中创建临时文件
+        :return: (文件对象, 临时文件路径)
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        return os.fdopen(fd, 'wb'), temp_path
+
+    def commit(self, song_id, temp_path, sha256, size):
+        """
+        将写好的临时文件原子地放入缓存，并按配额淘汰旧文件
+        :return: 缓存文件路径
+        """
+        path = self.path_for(song_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO download_cache (song_id, size, last_access, sha256) VALUES (?, ?, ?, ?)',
+                    (song_id, size, time.time(), sha256)
+                )
+                evicted = self._evict(conn, keep=song_id)
+        # 索引提交后再删除文件，被淘汰的文件不会再被其他进程命中；
+        # 正在上传该文件的任务已持有打开的文件，删除后仍能读完
+        for evicted_id in evicted:
+            try:
+                os.remove(self.path_for(evicted_id))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # 部分平台上不能删除已打开的文件，留待同一首歌下次写入缓存时覆盖
+                logging.warning("删除被淘汰的下载缓存文件失败: %s - %s", evicted_id, str(e))
+            logging.info("下载缓存已淘汰: %s", evicted_id)
+        return path
+
+    def _evict(self, conn, keep):
+        """
+        按最后访问时间从索引中删除记录直到总大小不超过配额（调用方需在写事务中，其他进程的写入会等待）
+        :return: 被淘汰的歌曲 ID 列表
+        """
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM download_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        evicted = []
+        rows = conn.execute('SELECT song_id, size FROM download_cache ORDER BY last_access').fetchall()
+        for song_id, size in rows:
+            if total <= self.max_bytes:
+                break
+            if song_id == keep:
+                continue
+            total -= size
+            evicted.append(song_id)
+        conn.executemany('DELETE FROM download_cache WHERE song_id = ?', [(song_id,) for song_id in evicted])
+        return evicted
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            entries, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM download_cache').fetchone()
+        return {
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes
+        }
+
+
+suno_download_cache = SunoDownloadCache(
+    app.config['SUNO_CACHE_DIR'],
+    app.config['SUNO_CACHE_MAX_BYTES'],
+    app.config['CACHE_DB_PATH']
+)
+
+class StorageWriter:
+    """写入存储临时文件的同时计算 sha256，由 AudioStore.commit 放到最终位置"""
+
+    def __init__(self, f, temp_path):
+        self._file = f
+        self.temp_path = temp_path
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._digest.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 未提交（异常或主动放弃）时删除临时文件
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class AudioStore:
+    """
+    生成音频的存储
+    文件以内容哈希命名（相同内容只保存一份，不同内容不会互相覆盖），按哈希前缀分两级子目录存放
+    （如 ab/cd/abcd....mp3），避免单个目录中的文件过多；先写临时文件再原子重命名。
+    后台线程定期按保留时间和总容量配额清理最久未更新的文件，清理过程不持有请求路径上的锁
+    """
+    NAME_PATTERN = re.compile(r'[0-9a-f]{32}\.mp3')
+    TEMP_DIR = 'tmp'
+    LEGACY_PATTERN = re.compile(r'generated_music_\d{8}_\d{6}\.mp3')
+    # 旧版本直接放在 downloads/ 下、可以通过 /audio/ 访问的 Suno 下载文件
+    LEGACY_SUNO_PATTERN = re.compile(r'suno_[0-9A-Za-z_-]+\.mp3')
+
+    def __init__(self, root, legacy_dir, max_bytes=0, retention=0, sweep_interval=600):
+        self.root = root
+        self.legacy_dir = legacy_dir  # 旧版本直接保存在 downloads/ 下的 generated_music_*.mp3
+        self.max_bytes = max_bytes  # 0 表示不限制总容量
+        self.retention = retention  # 文件保留时间（秒），0 表示不按时间清理
+        self.sweep_interval = sweep_interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'files': 0, 'bytes': 0, 'removed': 0, 'removed_bytes': 0, 'last_sweep': None}
+
+    @classmethod
+    def name_for(cls, sha256):
+        return f'{sha256[:32]}.mp3'
+
+    def path_for(self, name):
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def create_temp_file(self):
+        """:return: StorageWriter，写完后交给 commit"""
+        temp_dir = os.path.join(self.root, self.TEMP_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.part')
+        return StorageWriter(os.fdopen(fd, 'wb'), temp_path)
+
+    def commit(self, writer):
+        """
+        把写好的临时文件原子地放到以内容哈希命名的位置
+        :return: 文件路径
+        """
+        writer.close()
+        path = self.path_for(self.name_for(writer.sha256))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(writer.temp_path, path)
+        return path
+
+    def resolve(self, filename):
+        """
+        把 /audio/<filename> 中的文件名解析为磁盘路径，兼容旧版本的平铺文件
+        只解析音频文件名，旧目录中的其他文件（如缓存数据库）一律不可访问
+        :return: 文件路径，不存在或文件名不合法时返回 None
+        """
+        if self.NAME_PATTERN.fullmatch(filename):
+            path = self.path_for(filename)
+        elif self.LEGACY_PATTERN.fullmatch(filename) or self.LEGACY_SUNO_PATTERN.fullmatch(filename):
+            path = safe_join(os.path.abspath(self.legacy_dir), filename)
+        else:
+            return None
+        if not path or not os.path.isfile(path):
+            return None
+        return os.path.abspath(path)
+
+    def etag_for(self, filename):
+        """内容哈希命名的文件名本身就是强 ETag，无需再读取文件计算；旧文件返回 None"""
+        if self.NAME_PATTERN.fullmatch(filename):
+            return filename[:-len('.mp3')]
+        return None
+
+    def _scan(self):
+        """遍历两级分片目录，返回 [(修改时间, 大小, 路径)]"""
+        files = []
+        if not os.path.isdir(self.root):
+            return files
+        for first in os.scandir(self.root):
+            if not first.is_dir() or len(first.name) != 2:
+                continue
+            for second in os.scandir(first.path):
+                if not second.is_dir():
+                    continue
+                for entry in os.scandir(second.path):
+                    if entry.is_file() and self.NAME_PATTERN.fullmatch(entry.name):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def sweep(self):
+        """执行一次清理：过期文件、超出配额的最旧文件、残留的临时文件和过期的旧版文件"""
+        started = time.monotonic()
+        now = time.time()
+        removed = 0
+        removed_bytes = 0
+
+        files = sorted(self._scan())
+        kept = []
+        for mtime, size, path in files:
+            if self.retention and mtime < now - self.retention:
+                if self._remove(path):
+                    removed += 1
+                    removed_bytes += size
+            else:
+                kept.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in kept)
+        if self.max_bytes:
+            while kept and total > self.max_bytes:
+                mtime, size, path = kept.pop(0)
+                if self._remove(path):
+                    removed += 1
+                    removed_bytes += size
+                total -= size
+
+        # 进程异常退出时残留的临时文件
+        temp_dir = os.path.join(self.root, self.TEMP_DIR)
+        if os.path.isdir(temp_dir):
+            for entry in os.scandir(temp_dir):
+                if entry.is_file() and entry.stat().st_mtime < now - 3600:
+                    self._remove(entry.path)
+
+        if self.retention and os.path.isdir(self.legacy_dir):
+            for entry in os.scandir(self.legacy_dir):
+                if entry.is_file() and self.LEGACY_PATTERN.fullmatch(entry.name):
+                    stat = entry.stat()
+                    if stat.st_mtime < now - self.retention and self._remove(entry.path):
+                        removed += 1
+                        removed_bytes += stat.st_size
+
+        with self._stats_lock:
+            self._stats['files'] = len(kept)
+            self._stats['bytes'] = total
+            self._stats['removed'] += removed
+            self._stats['removed_bytes'] += removed_bytes
+            self._stats['last_sweep'] = now
+        if removed:
+            logging.info("音频存储清理完成: 删除 %d 个文件（%d 字节），耗时 %.2f 秒",
+                         removed, removed_bytes, time.monotonic() - started)
+
+    def start_sweeper(self):
+        """启动后台清理线程（重复调用无副作用）"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._sweep_loop, name='storage-sweeper', daemon=True)
+        self._thread.start()
+
+    def _sweep_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.warning("音频存储清理失败: %s", str(e))
+            self._stopped.wait(self.sweep_interval)
+
+    def stop_sweeper(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, max_bytes=self.max_bytes, retention=self.retention)
+
+
+audio_store = AudioStore(
+    app.config['GENERATED_DIR'],
+    app.config['UPLOAD_FOLDER'],
+    max_bytes=app.config['GENERATED_MAX_BYTES'],
+    retention=app.config['GENERATED_RETENTION_SECONDS'],
+    sweep_interval=app.config['STORAGE_SWEEP_INTERVAL']
+)
+
+def file_sha256(file_path):
+    """分块计算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def connect_cache_db(db_path):
+    """打开缓存数据库连接，多个进程/线程可同时读写"""
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+class UploadCache:
+    """
+    Minimax 上传结果的持久化缓存（SQLite）
+    以音频内容的 sha256 为键记录 voice_id / instrumental_id，超过 ttl 秒的记录视为已被服务端清理
+    """
+
+    def __init__(self, db_path, ttl):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._initialized = False
+
+    def _connect(self):
+        conn = connect_cache_db(self.db_path)
+        if not self._initialized:
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS upload_cache ('
+                    'content_hash TEXT PRIMARY KEY, '
+                    'voice_id TEXT NOT NULL, '
+                    'instrumental_id TEXT NOT NULL, '
+                    'created_at REAL NOT NULL)'
+                )
+            self._initialized = True
+        return conn
+
+    def get(self, content_hash):
+        """
+        查找未过期的上传结果
+        :return: {'voice_id': ..., 'instrumental_id': ...}，未命中时返回 None
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT voice_id, instrumental_id FROM upload_cache WHERE content_hash = ? AND created_at > ?',
+                (content_hash, time.time() - self.ttl)
+            ).fetchone()
+        if not row:
+            metrics.inc('music_cache_misses_total', cache='upload')
+            return None
+        metrics.inc('music_cache_hits_total', cache='upload')
+        return {'voice_id': row[0], 'instrumental_id': row[1]}
+
+    def put(self, content_hash, voice_id, instrumental_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO upload_cache (content_hash, voice_id, instrumental_id, created_at) '
+                'VALUES (?, ?, ?, ?)',
+                (content_hash, voice_id, instrumental_id, time.time())
+            )
+            # 顺便清理过期记录
+            conn.execute('DELETE FROM upload_cache WHERE created_at <= ?', (time.time() - self.ttl,))
+
+    def is_valid(self, reference):
+        """上传结果（upload_reference 的返回值）是否仍在缓存中且未过期、未被判定为失效，不计入命中率"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT 1 FROM upload_cache WHERE content_hash = ? AND voice_id = ? AND instrumental_id = ? '
+                'AND created_at > ?',
+                (reference['content_hash'], reference['voice_id'], reference['instrumental_id'],
+                 time.time() - self.ttl)
+            ).fetchone()
+        return row is not None
+
+    def invalidate(self, content_hash):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM upload_cache WHERE content_hash = ?', (content_hash,))
+
+
+upload_cache = UploadCache(app.config['CACHE_DB_PATH'], app.config['UPLOAD_CACHE_TTL'])
+
+class SingleFlight:
+    """
+    合并相同输入的并发调用：同一个键同一时间只执行一次，其余调用方等待并共享其结果或异常
+    执行过程中报告的进度会转发给所有等待该键的调用方；只能在任务事件循环中使用
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.executed = 0
+        self.coalesced = 0
+        self._calls = {}  # 键 -> 正在执行的 asyncio.Task
+        self._listeners = {}  # 键 -> 进度回调列表
+        self._waiters = defaultdict(int)  # 键 -> 等待中的调用方数量
+        self._deadlines = {}  # 键 -> 共享调用的截止时间，取所有等待方中最晚的一个
+
+    async def do(self, key, coro_func, listener=None):
+        """
+        :param key: 调用的输入标识
+        :param coro_func: 协程函数，参数为进度报告函数 report(event_type, data)，
+                          只有该键当前没有进行中的调用时才会执行
+        :param listener: 接收进度的回调 listener(event_type, data)
+        """
+        listeners = self._listeners.setdefault(key, [])
+        if listener is not None:
+            listeners.append(listener)
+        # 没有截止时间的调用方最多等待 JOB_DEADLINE_SECONDS
+        deadline = current_deadline.get()
+        expires_at = deadline.expires_at if deadline else time.monotonic() + app.config['JOB_DEADLINE_SECONDS']
+        task = self._calls.get(key)
+        if task is None:
+            shared = self._deadlines[key] = Deadline(expires_at=expires_at)
+            task = asyncio.ensure_future(self._run_shared(coro_func, functools.partial(self._report, listeners), shared))
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._finish, key))
+            self.executed += 1
+        else:
+            # 共享的调用不能因为最先发起的任务截止时间较早而提前失败
+            self._deadlines[key].extend(expires_at)
+            self.coalesced += 1
+            metrics.inc('music_single_flight_coalesced_total', stage=self.name)
+            logging.info("%s 合并到进行中的相同调用: %s", self.name, key)
+        self._waiters[key] += 1
+        try:
+            # 某个调用方被取消时不影响其他仍在等待的调用方
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 最后一个调用方也被取消时取消这次调用，不再为无人等待的结果消耗上游配额
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+            if listener is not None and listener in listeners:
+                listeners.remove(listener)
+
+    @staticmethod
+    async def _run_shared(coro_func, report, shared):
+        """
+        执行共享的调用：使用所有等待方中最晚的截止时间（新的调用方加入时推迟），不随发起方取消
+        （由 do 在最后一个调用方取消时取消），取消时同时取消截止时间，使线程池中的阻塞调用尽快退出
+        """
+        current_deadline.set(shared)
+        try:
+            return await coro_func(report)
+        except asyncio.CancelledError:
+            shared.cancel('调用已取消')
+            raise
+
+    @staticmethod
+    def _report(listeners, event_type, data=None):
+        # 上传在线程池中执行，回调可能来自其他线程，先复制列表
+        for listener in list(listeners):
+            try:
+                listener(event_type, data)
+            except Exception as e:
+                logging.warning("进度回调出错: %s", str(e))
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            self._listeners.pop(key, None)
+            self._deadlines.pop(key, None)
+        # 所有调用方都已取消时避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'executed': self.executed,
+            'coalesced': self.coalesced
+        }
+
+
+class ProgressReporter:
+    """按百分比节流的字节进度报告，避免每个数据块都产生一个事件"""
+
+    def __init__(self, report, event_type, total=None, step=5):
+        self.report = report
+        self.event_type = event_type
+        self.total = total
+        self.step = step
+        self.done = 0
+        self._last_percent = -step
+        self._last_bytes = 0
+
+    def advance(self, size):
+        if not self.report or not size:
+            return
+        self.done += size
+        if self.total:
+            percent = min(100, self.done * 100 // self.total)
+            if percent - self._last_percent < self.step and self.done < self.total:
+                return
+            self._last_percent = percent
+        elif self.done - self._last_bytes < 1024 * 1024:
+            return
+        self._last_bytes = self.done
+        self.report(self.event_type, {'bytes': self.done, 'total': self.total})
+
+
+class MultipartFileBody:
+    """
+    流式 multipart/form-data 请求体：按块读取文件，不把整个文件读入内存，并报告已发送的字节数
+    requests 根据 __len__ 设置 Content-Length，通过 read() 分块发送
+    文件由调用方打开并负责关闭：长度取自已打开的文件，发送期间文件被删除（如下载缓存淘汰）也能读完整内容
+    """
+
+    def __init__(self, fields, file_field, file, mime_type, progress=None):
+        self.boundary = uuid.uuid4().hex
+        filename = os.path.basename(file.name).replace('"', '%22')
+        head = ''.join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: {mime_type}\r\n\r\n'
+        )
+        self._segments = [head.encode('utf-8'), None, f'\r\n--{self.boundary}--\r\n'.encode('utf-8')]
+        # 重试时复用同一个文件对象，从头读取
+        file.seek(0)
+        self._file = file
+        self._length = len(self._segments[0]) + os.fstat(file.fileno()).st_size + len(self._segments[2])
+        self._index = 0
+        self._offset = 0
+        self._progress = ProgressReporter(progress, 'upload_progress', self._length)
+        # 任务超时或被取消时在发送下一块之前中止上传
+        self._deadline = current_deadline.get()
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if self._deadline:
+            self._deadline.check()
+        if size is None or size < 0:
+            size = self._length
+        out = bytearray()
+        while len(out) < size and self._index < len(self._segments):
+            if self._index == 1:
+                piece = self._file.read(size - len(out))
+            else:
+                segment = self._segments[self._index]
+                piece = segment[self._offset:self._offset + size - len(out)]
+                self._offset += len(piece)
+            if not piece:
+                self._index += 1
+                self._offset = 0
+                continue
+            out += piece
+        self._progress.advance(len(out))
+        return bytes(out)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(65536)
+            if not chunk:
+                return
+            yield chunk
+
+
+# 按阶段输入合并并发调用：下载按歌曲 ID，上传按音频内容哈希，润色按润色缓存键
+download_flight = SingleFlight('download')
+upload_flight = SingleFlight('upload')
+polish_flight = SingleFlight('polish')
+
+
+class HexAudioStreamDecoder:
+    """
+    增量解析音乐生成接口的 JSON 响应
+    data.audio 字段中的十六进制内容按块解码后直接写入输出文件，其余很小的 JSON 骨架保留在内存中，
+    因此每次生成的峰值内存与歌曲长度无关
+    """
+    AUDIO_FIELD = re.compile(rb'"audio"\s*:\s*"')
+    MAX_SKELETON_BYTES = 1024 * 1024
+
+    def __init__(self, output):
+        """
+        :param output: 以二进制方式打开的输出文件对象
+        """
+        self.output = output
+        self.found_audio = False
+        self.audio_bytes = 0
+        self._skeleton = bytearray()  # audio 字段内容被去掉后的 JSON
+        self._in_audio = False
+        self._pending_hex = b''  # 上一块末尾剩下的半个字节
+
+    def feed(self, chunk):
+        while chunk:
+            if self._in_audio:
+                end = chunk.find(b'"')
+                self._write_hex(chunk if end < 0 else chunk[:end])
+                if end < 0:
+                    return
+                if self._pending_hex:
+                    raise ValueError("音频数据长度不是偶数")
+                self._in_audio = False
+                self._skeleton += b'"'
+                chunk = chunk[end + 1:]
+            else:
+                search_from = max(0, len(self._skeleton) - 64)
+                self._skeleton += chunk
+                chunk = b''
+                if len(self._skeleton) > self.MAX_SKELETON_BYTES:
+                    raise ValueError("响应中非音频内容过大")
+                if self.found_audio:
+                    continue
+                match = self.AUDIO_FIELD.search(self._skeleton, search_from)
+                if match:
+                    chunk = bytes(self._skeleton[match.end():])
+                    del self._skeleton[match.end():]
+                    self._in_audio = True
+                    self.found_audio = True
+
+    def _write_hex(self, hex_part):
+        data = self._pending_hex + hex_part
+        usable = len(data) - len(data) % 2
+        self._pending_hex = data[usable:]
+        if usable:
+            audio = bytes.fromhex(data[:usable].decode('ascii'))
+            self.output.write(audio)
+            self.audio_bytes += len(audio)
+
+    def close(self):
+        """
+        结束解析
+        :return: 去掉音频内容后的响应 JSON（audio 字段为空字符串）
+        """
+        if self._in_audio:
+            raise ValueError("响应在音频数据中途结束")
+        text = self._skeleton.decode('utf-8').strip()
+        if not text:
+            raise ValueError("响应内容为空")
+        return json.loads(text)
+
+
+class ReferenceClipper:
+    """
+    上传前的参考音频预处理（可选，默认关闭，依赖 ffmpeg）
+    只截取一段有代表性的片段（跳过前奏，从全曲约 30% 处开始），并按参考音频所需的采样率和码率重新编码，
+    以减少上传字节数和上传耗时。未安装 ffmpeg、处理失败或结果不比原文件小时直接上传原文件
+    """
+    # 片段起点相对全曲时长的位置，避开前奏
+    SEGMENT_POSITION = 0.3
+    DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+    def __init__(self, mode='off', clip_seconds=30, sample_rate=32000, bitrate='128k',
+                 ffmpeg_path='ffmpeg', timeout=60):
+        self.mode = mode  # auto：安装了 ffmpeg 时启用；on：总是启用；off：关闭
+        self.clip_seconds = clip_seconds
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+        self.ffmpeg = shutil.which(ffmpeg_path)
+        self.timeout = timeout
+        if self.mode == 'on' and not self.ffmpeg:
+            logging.warning("REFERENCE_TRIM=on 但未找到 ffmpeg，将上传完整音频")
+
+    @property
+    def enabled(self):
+        return self.mode != 'off' and bool(self.ffmpeg)
+
+    def cache_key(self, content_hash):
+        """上传缓存的键：截取参数变化后需要重新上传"""
+        if not self.enabled:
+            return content_hash
+        return f'{content_hash}:clip-{self.clip_seconds:g}s-{self.sample_rate}hz-{self.bitrate}'
+
+    def probe_duration(self, file_path):
+        """:return: 音频时长（秒），无法识别时返回 None"""
+        # 只读取文件头，ffmpeg 因未指定输出文件而返回非零状态，时长从 stderr 中解析
+        result = subprocess.run(
+            [self.ffmpeg, '-hide_banner', '-i', file_path],
+            capture_output=True, text=True, timeout=self.timeout
+        )
+        match = self.DURATION_PATTERN.search(result.stderr)
+        if not match:
+            return None
+        hours, minutes, seconds = match.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    def segment_for(self, duration):
+        """:return: (起点秒数, 时长秒数)"""
+        if duration <= self.clip_seconds:
+            return 0.0, duration
+        start = min(duration * self.SEGMENT_POSITION, duration - self.clip_seconds)
+        return round(start, 3), float(self.clip_seconds)
+
+    @instrumented('trim_reference')
+    def prepare(self, file_path):
+        """
+        生成截取后的参考音频临时文件，由调用方在上传后删除
+        :return: 临时文件路径，不需要或无法处理时返回 None
+        """
+        if not self.enabled:
+            return None
+        try:
+            duration = self.probe_duration(file_path)
+            if not duration:
+                logging.warning("无法识别参考音频时长，上传完整音频: %s", file_path)
+                return None
+            start, length = self.segment_for(duration)
+
+            fd, clip_path = tempfile.mkstemp(suffix='.clip.mp3')
+            os.close(fd)
+            result = subprocess.run(
+                [self.ffmpeg, '-v', 'error', '-y', '-ss', str(start), '-t', str(length), '-i', file_path,
+                 '-vn', '-ac', '2', '-ar', str(self.sample_rate), '-b:a', self.bitrate, '-f', 'mp3', clip_path],
+                capture_output=True, text=True, timeout=self.timeout
+            )
+            original_size = os.path.getsize(file_path)
+            clip_size = os.path.getsize(clip_path) if result.returncode == 0 else 0
+            if not clip_size or clip_size >= original_size:
+                if result.returncode != 0:
+                    logging.warning("截取参考音频失败，上传完整音频: %s", result.stderr.strip()[:500])
+                os.remove(clip_path)
+                return None
+
+            metrics.inc('music_reference_bytes_saved_total', original_size - clip_size)
+            logging.info("参考音频已截取: %.1f-%.1f 秒，%d -> %d 字节", start, start + length, original_size, clip_size)
+            return clip_path
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.warning("截取参考音频失败，上传完整音频: %s", str(e))
+            return None
+
+
+reference_clipper = ReferenceClipper(
+    mode=app.config['REFERENCE_TRIM'],
+    clip_seconds=app.config['REFERENCE_CLIP_SECONDS'],
+    sample_rate=app.config['REFERENCE_SAMPLE_RATE'],
+    bitrate=app.config['REFERENCE_BITRATE'],
+    ffmpeg_path=app.config['FFMPEG_PATH']
+)
+
+
+class MusicGenerator:
+    def __init__(self):
+        """
+        初始化音乐生成器
+        """
+        self.api_key = os.getenv('MINIMAX_API_KEY')
+        if not self.api_key:
+            raise ValueError("Missing MINIMAX_API_KEY in environment variables")
+            
+        self.upload_url = f"{app.config['MINIMAX_BASE_URL']}/v1/music_upload"
+        self.generation_url = f"{app.config['MINIMAX_BASE_URL']}/v1/music_generation"
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        logging.info("MusicGenerator initialized")
+
+    @instrumented('upload_file')
+    def upload_file(self, file_path, timeout=None, max_retries=None, progress=None):
+        """
+        上传音频文件
+        :param file_path: 音频文件路径
+        :param timeout: 请求超时时间（秒），默认使用共享客户端的超时配置
+        :param max_retries: 最大重试次数，默认使用 MINIMAX_MAX_RETRIES
+        :param progress: 进度回调 progress('upload_progress', {'bytes', 'total'})
+        :return: 上传后的文件ID
+        """
+        # 整个上传（包括重试）期间保持文件打开，下载缓存此时淘汰该文件也不影响读取
+        try:
+            audio_file = open(file_path, 'rb')
+        except FileNotFoundError:
+            logging.error(f"文件不存在: {file_path}")
+            return None
+        with audio_file:
+            return self._upload_open_file(audio_file, timeout, max_retries, progress)
+
+    def _upload_open_file(self, audio_file, timeout, max_retries, progress):
+        """upload_file 的实现，audio_file 为已打开的音频文件"""
+        file_path = audio_file.name
+        # 获取文件的MIME类型
+        mime_type = mimetypes.guess_type(file_path)[0] or 'audio/mpeg'
+        
+        # 构建multipart/form-data请求
+        payload = {
+            'purpose': 'song'  # 设置purpose为song
+        }
+        attempts = 0
+
+        def send():
+            nonlocal attempts
+            attempts += 1
+            logging.info(f"开始上传文件（第{attempts}次尝试）: {os.path.basename(file_path)}")
+            # 每次尝试重新构造流式请求体，从头边读文件边发送
+            body = MultipartFileBody(payload, 'file', audio_file, mime_type, progress=progress)
+            response = http_client.session.post(
+                self.upload_url,
+                headers={
+                    'Authorization': f"Bearer {self.api_key}",
+                    'Content-Type': body.content_type
+                },
+                data=body,
+                timeout=http_client.request_timeout(timeout)
+            )
+            metrics.inc('music_bytes_total', len(body), stage='upload_file', direction='out')
+            check_retryable_status(response.status_code, response.headers)
+            response.raise_for_status()
+            result = response.json()
+            check_minimax_base_resp(result)
+            return result
+
+        try:
+            result = call_with_retry('upload', send, max_retries)
+            logging.debug("上传响应数据: %s", json.dumps(result, ensure_ascii=False))
+            
+            if result.get('base_resp', {}).get('status_code') == 0:
+                return result
+            else:
+                logging.error(f"上传失败响应: {result}")
+                return None
+                
+        except RetryableError as e:
+            logging.error(f"上传多次失败，放弃重试: {str(e)}")
+            return None
+        except requests.exceptions.RequestException as e:
+            logging.error(f"上传请求失败: {str(e)}")
+            return None
+        except Exception as e:
+            logging.error(f"上传文件时发生错误: {str(e)}")
+            return None
+
+    def separate_audio(self, file_path):
+        """
+        分离音频文件为人声和伴奏
+        :param file_path: 音频文件路径
+        :return: (voice_id, instrumental_id) 元组
+        """
+        try:
+            logging.info(f"开始分离音频: {os.path.basename(file_path)}")
+            
+            # 上传原始文件
+            file_id = self.upload_file(file_path)
+            if not file_id:
+                return None, None
+            
+            # 调用分离API
+            separate_url = f"{self.upload_url}/separate"
+            payload = {"file_id": file_id}
+            
+            def send():
+                response = http_client.session.post(
+                    separate_url,
+                    headers=self.headers,
+                    json=payload,
+                    timeout=http_client.request_timeout()
+                )
+                check_retryable_status(response.status_code, response.headers)
+                response.raise_for_status()
+                result = response.json()
+                check_minimax_base_resp(result)
+                return result
+
+            result = call_with_retry('separate', send)
+            if result.get("status") == "success":
+                voice_id = result.get("voice_id")
+                instrumental_id = result.get("instrumental_id")
+                logging.info(f"音频分离成功 - 人声ID: {voice_id}, 伴奏ID: {instrumental_id}")
+                return voice_id, instrumental_id
+            else:
+                raise Exception(f"分离失败: {result.get('message')}")
+                
+        except Exception as e:
+            logging.error(f"分离音频时发生错误: {str(e)}")
+            return None, None
+
+    def reference_hash(self, voice_path):
+        """参考音频的内容哈希，下载缓存中的文件直接使用索引里的校验值"""
+        return suno_download_cache.checksum_for_file(voice_path) or file_sha256(voice_path)
+
+    def upload_reference(self, voice_path, content_hash=None, progress=None):
+        """
+        上传参考音频，同一份音频在有效期内上传过则直接复用缓存的 voice_id / instrumental_id
+        :param voice_path: 音频文件路径
+        :param content_hash: 已计算好的内容哈希
+        :param progress: 上传进度回调
+        :return: {'voice_id', 'instrumental_id', 'content_hash', 'cached'}，上传失败时返回 None
+        """
+        content_hash = content_hash or self.reference_hash(voice_path)
+        # 启用截取时缓存键包含截取参数，返回值中的 content_hash 即为该键
+        cache_key = reference_clipper.cache_key(content_hash)
+        cached_upload = upload_cache.get(cache_key)
+        if cached_upload:
+            logging.info(f"命中上传缓存 - voice_id: {cached_upload['voice_id']}, instrumental_id: {cached_upload['instrumental_id']}")
+            return dict(cached_upload, content_hash=cache_key, cached=True)
+
+        clip_path = reference_clipper.prepare(voice_path)
+        try:
+            logging.info("开始上传音频文件...")
+            upload_response = self.upload_file(clip_path or voice_path, progress=progress)
+        finally:
+            if clip_path and os.path.exists(clip_path):
+                os.remove(clip_path)
+
+        if not isinstance(upload_response, dict):
+            logging.error("上传失败，无法获取音频ID")
+            return None
+
+        voice_id = upload_response.get('voice_id', '')
+        instrumental_id = upload_response.get('instrumental_id', '')
+        logging.info(f"上传成功 - voice_id: {voice_id}, instrumental_id: {instrumental_id}")
+        if voice_id or instrumental_id:
+            upload_cache.put(cache_key, voice_id, instrumental_id)
+        return {
+            'voice_id': voice_id,
+            'instrumental_id': instrumental_id,
+            'content_hash': cache_key,
+            'cached': False
+        }
+
+    @instrumented('generate_music')
+    async def generate_music(self, prompt=None, style="classical", duration=30, voice_path=None, instrumental_path=None, lyrics=None, reference=None):
+        """
+        异步生成音乐，需在任务事件循环中调用（使用共享的 aiohttp 会话）
+        :param voice_path: 参考音频路径，未提供 reference 时先上传该文件
+        :param reference: upload_reference 的返回值，已上传过参考音频时传入
+        :return: 生成的音频文件路径，失败时返回 None
+        """
+        try:
+            logging.info("=== 开始生成音乐 ===")
+            logging.info(f"音频文件路径: {voice_path}")
+            logging.debug("歌词内容: %s", lyrics)
+            
+            if reference is None and voice_path:
+                reference = await asyncio.to_thread(self.upload_reference, voice_path)
+                if not reference:
+                    return None
+
+            voice_id = reference['voice_id'] if reference else None
+            instrumental_id = reference['instrumental_id'] if reference else None
+
+            # 在歌词前后添加 ##
+            if lyrics:
+                lyrics = f"##\n{lyrics}\n##"
+
+            # 构建请求参数
+            payload = {
+                'refer_voice': voice_id if voice_id else "",
+                'refer_instrumental': instrumental_id if instrumental_id else "",
+                'lyrics': lyrics if lyrics else "",
+                'model': 'music-01',
+                'audio_setting': '{"sample_rate":44100,"bitrate":256000,"format":"mp3"}'
+            }
+            
+            try:
+                logging.info("开始生成音乐...")
+                logging.debug("生成请求数据: %s", json.dumps(payload, ensure_ascii=False))
+                
+                output_file = await call_with_retry_async('generation', functools.partial(self._request_generation, payload))
+                logging.info(f"音乐生成成功，保存为: {output_file}")
+                return output_file
+                
+            except Exception as e:
+                logging.error(f"生成音乐时发生错误: {str(e) or type(e).__name__}")
+                # 超时不代表缓存的音频ID失效
+                if reference and reference['cached'] and not isinstance(e, (asyncio.TimeoutError, DeadlineExceeded)):
+                    # 缓存的音频ID可能已在服务端失效，下次重新上传，同一音频的预取结果也不再使用
+                    await asyncio.to_thread(upload_cache.invalidate, reference['content_hash'])
+                    job_manager.discard_prefetch(reference['content_hash'])
+                return None
+
+        except Exception as e:
+            logging.error("=== 生成音乐时发生错误 ===")
+            logging.error(f"错误类型: {type(e)}")
+            logging.error(f"错误信息: {str(e)}")
+            logging.error("详细堆栈:", exc_info=True)
+            return None
+
+    async def _request_generation(self, payload):
+        """
+        发起一次音乐生成请求，流式读取响应，音频边接收边解码写入文件
+        :return: 生成的音频文件路径
+        """
+        session = http_client.aiohttp_session()
+        async with session.post(
+            self.generation_url,
+            headers={'Authorization': f"Bearer {self.api_key}"},
+            data=payload,
+            timeout=http_client.aiohttp_timeout()
+        ) as response:
+            logging.info(f"响应状态码: {response.status}")
+            if response.status != 200:
+                logging.error(f"响应内容: {(await response.text())[:2000]}")
+                check_retryable_status(response.status, response.headers)
+                raise Exception(f"请求失败: HTTP {response.status}")
+
+            # 先写入存储的临时文件，成功后以内容哈希命名放入存储
+            with audio_store.create_temp_file() as writer:
+                decoder = HexAudioStreamDecoder(writer)
+                async for chunk in response.content.iter_chunked(65536):
+                    decoder.feed(chunk)
+                try:
+                    result = decoder.close()
+                except ValueError as e:
+                    logging.error(f"JSON解析错误: {str(e)}")
+                    raise Exception("响应格式错误")
+
+                # 响应日志中不包含音频内容
+                logging.info(f"响应内容（不含音频）: {json.dumps(result, ensure_ascii=False)}")
+
+                if not (decoder.found_audio and decoder.audio_bytes):
+                    check_minimax_base_resp(result)
+                    error_msg = result.get('base_resp', {}).get('status_msg', '未知错误')
+                    raise Exception(f"生成失败: {error_msg}")
+
+                output_file = audio_store.commit(writer)
+
+        logging.info(f"音频大小: {decoder.audio_bytes} 字节")
+        metrics.inc('music_bytes_total', decoder.audio_bytes, stage='generate_music', direction='in')
+        return output_file
+
+    @instrumented('download_suno_audio')
+    async def download_suno_audio(self, suno_url, progress=None):
+        """
+        异步下载 Suno 音频文件，已缓存的歌曲直接返回缓存文件
+        :param progress: 下载进度回调 progress('download_progress', {'bytes', 'total'})
+        """
+        try:
+            logging.info("开始下载Suno音频: %s", suno_url)
+            
+            # 从URL中提取音频ID
+            song_id = extract_suno_song_id(suno_url)
+            if not song_id:
+                logging.error("无法从链接中解析歌曲ID: %s", suno_url)
+                return None
+
+            cached_file = suno_download_cache.get(song_id)
+            if cached_file:
+                logging.info("命中下载缓存: %s", cached_file)
+                return cached_file
+
+            # 同一首歌的并发下载只请求一次 CDN
+            return await download_flight.do(
+                song_id,
+                functools.partial(self._fetch_suno_audio, song_id),
+                listener=progress
+            )
+
+        except Exception as e:
+            logging.error("下载Suno音频时发生错误: %s", str(e))
+            return None
+
+    async def _fetch_suno_audio(self, song_id, report):
+        """从 Suno CDN 下载音频并放入下载缓存，失败时返回 None"""
+        # 构建实际的音频URL
+        audio_url = f"{app.config['SUNO_CDN_URL']}/{song_id}.mp3"
+        
+        # 更新请求头，模拟真实浏览器请求
+        headers = {
+            'Accept-Encoding': 'identity;q=1, *;q=0',
+            'Referer': 'https://suno.com/',
+            'User-Agent': 'Mozilla/5.0 (Linux; Android) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.109 Safari/537.36 CrKey/1.54.248666'
+        }
+        
+        session = http_client.aiohttp_session()
+        async with session.get(audio_url, headers=headers, timeout=http_client.aiohttp_timeout()) as response:
+            if response.status != 200:
+                logging.error("下载失败，状态码: %d", response.status)
+                return None
+
+            # 先写入临时文件并计算校验值，完成后再原子地放入缓存
+            f, temp_path = suno_download_cache.create_temp_file()
+            try:
+                digest = hashlib.sha256()
+                size = 0
+                reporter = ProgressReporter(report, 'download_progress', response.content_length)
+                with f:
+                    while True:
+                        chunk = await response.content.read(65536)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                        reporter.advance(len(chunk))
+                output_file = suno_download_cache.commit(song_id, temp_path, digest.hexdigest(), size)
+                metrics.inc('music_bytes_total', size, stage='download_suno_audio', direction='in')
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+            logging.info("Suno音频下载成功: %s", output_file)
+            return output_file
+
+    def generate_from_suno(self, suno_url, prompt=None, style="classical", duration=30):
+        try:
+            # 在任务事件循环上下载（共享的 aiohttp 会话绑定在该循环上），当前线程同步等待结果
+            downloaded_file = job_manager.run_coroutine(self.download_suno_audio(suno_url))
+            
+            if not downloaded_file:
+                logging.error("Suno音频下载失败")
+                return None
+            
+            logging.info(f"Suno音频下载成功: {downloaded_file}")
+            
+            # 2. 使用下载的音频生成新的音频
+            output_file = job_manager.run_coroutine(self.generate_music(
+                prompt=prompt or "基于上传的音频创作一段优美的音乐，保持原曲风格",
+                style=style,
+                duration=duration,
+                voice_path=downloaded_file
+            ))
+            
+            if output_file:
+                logging.info(f"基于Suno音频生成新音频成功: {output_file}")
+            else:
+                logging.error("基于Suno音频生成新音频失败")
+            
+            return output_file
+            
+        except Exception as e:
+            logging.error(f"从Suno音频生成新音频时发生错误: {str(e)}")
+            return None
+
+class PolishCache:
+    """
+    歌词润色结果的两级缓存：进程内 LRU 在前，SQLite 持久化在后
+    键由规范化后的歌词、模型名和提示词版本共同决定，修改提示词时提升版本号即可让旧结果失效
+    超过 ttl 秒的结果不再使用；持久化的记录在写入时清理，旧版本提示词留下的记录也随之过期
+    """
+
+    def __init__(self, db_path, max_entries=1024, ttl=30 * 24 * 3600, max_rows=0):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._initialized = False
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(lyrics, model, prompt_version):
+        # 统一换行符并去掉每行首尾空白，避免仅因空白不同而未命中
+        normalized = '\n'.join(
+            line.strip() for line in lyrics.replace('\r\n', '\n').replace('\r', '\n').strip().split('\n')
+        )
+        raw = json.dumps([normalized, model, prompt_version], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _connect(self):
+        conn = connect_cache_db(self.db_path)
+        if not self._initialized:
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS polish_cache ('
+                    'cache_key TEXT PRIMARY KEY, '
+                    'polished_lyrics TEXT NOT NULL, '
+                    'created_at REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS polish_cache_created_at ON polish_cache (created_at)')
+            self._initialized = True
+        return conn
+
+    def _remember(self, key, value, created_at):
+        """写入进程内 LRU（调用方需持有锁）"""
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        expire_before = time.time() - self.ttl
+        with self._lock:
+            if key in self._memory:
+                value, created_at = self._memory[key]
+                if created_at > expire_before:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    metrics.inc('music_cache_hits_total', cache='polish_memory')
+                    return value
+                del self._memory[key]
+
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT polished_lyrics, created_at FROM polish_cache WHERE cache_key = ? AND created_at > ?',
+                (key, expire_before)
+            ).fetchone()
+
+        with self._lock:
+            if row:
+                self.disk_hits += 1
+                self._remember(key, row[0], row[1])
+                metrics.inc('music_cache_hits_total', cache='polish_disk')
+                return row[0]
+            self.misses += 1
+            metrics.inc('music_cache_misses_total', cache='polish')
+            return None
+
+    def put(self, key, polished_lyrics):
+        now = time.time()
+        with self._lock:
+            self._remember(key, polished_lyrics, now)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO polish_cache (cache_key, polished_lyrics, created_at) VALUES (?, ?, ?)',
+                (key, polished_lyrics, now)
+            )
+            # 顺便清理过期记录，以及超出条数上限的最旧记录
+            conn.execute('DELETE FROM polish_cache WHERE created_at <= ?', (now - self.ttl,))
+            if self.max_rows:
+                conn.execute(
+                    'DELETE FROM polish_cache WHERE created_at < ('
+                    'SELECT created_at FROM polish_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?)',
+                    (self.max_rows - 1,)
+                )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+
+polish_cache = PolishCache(
+    app.config['CACHE_DB_PATH'],
+    app.config['POLISH_CACHE_MAX_ENTRIES'],
+    ttl=app.config['POLISH_CACHE_TTL'],
+    max_rows=app.config['POLISH_CACHE_MAX_ROWS']
+)
+
+
+class RhythmPolisher:
+    """
+    本地规则润色：根据标点、短语长度和中日韩字符数插入换行，不调用任何接口，结果是确定的
+    与 LLM 润色一样只调整换行，不改动歌词内容；原有的换行和段落保持不变
+    """
+    # 句末标点后长停顿（空行），句中标点后短停顿（换行）
+    LONG_PAUSE = '。！？!?…'
+    SHORT_PAUSE = '，、；：,;:'
+    CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af'
+    # 中日韩文字按单字计，其他文字按单词计
+    TOKEN_PATTERN = re.compile(f'[{CJK}]|[^\\s{CJK}]+')
+    # 只在连续标点（如"？！"、"……"）的末尾断开
+    PAUSE_PATTERN = re.compile(f'(?<=[{re.escape(LONG_PAUSE + SHORT_PAUSE)}])(?![{re.escape(LONG_PAUSE + SHORT_PAUSE)}])')
+
+    def __init__(self, max_phrase=12):
+        self.max_phrase = max_phrase
+
+    def polish(self, lyrics):
+        """:return: 与 LyricsPolisher.polish_lyrics 相同格式（##...##）的润色结果"""
+        stanzas = []
+        for stanza in re.split(r'\n\s*\n', lyrics.strip()):
+            text = ''
+            for line in stanza.split('\n'):
+                for phrase in self.PAUSE_PATTERN.split(line.strip()):
+                    phrase = phrase.strip()
+                    if not phrase:
+                        continue
+                    # 结尾的连续标点中有句末标点时为长停顿
+                    ending = phrase[len(phrase.rstrip(self.LONG_PAUSE + self.SHORT_PAUSE)):]
+                    pause = '\n\n' if any(char in self.LONG_PAUSE for char in ending) else '\n'
+                    text += '\n'.join(self._wrap(phrase)) + pause
+                # 原有的换行至少保留为短停顿
+                if text and not text.endswith('\n'):
+                    text += '\n'
+            if text.strip():
+                stanzas.append(text.strip('\n'))
+        return "##" + '\n\n'.join(stanzas) + "##"
+
+    def _tokens(self, phrase):
+        """切分为计数单位，单独的标点并入前一个单位，避免断行后一行只剩标点"""
+        tokens = []
+        for token in self.TOKEN_PATTERN.findall(phrase):
+            if tokens and not any(char.isalnum() for char in token):
+                tokens[-1] += token
+            else:
+                tokens.append(token)
+        return tokens
+
+    def _wrap(self, phrase):
+        """超过 max_phrase 的短语优先在空格处断行，没有空格时按字数平均切分"""
+        if len(self._tokens(phrase)) <= self.max_phrase:
+            return [phrase]
+        words = phrase.split()
+        if len(words) > 1:
+            lines, current = [], []
+            for word in words:
+                if current and len(self._tokens(' '.join(current + [word]))) > self.max_phrase:
+                    lines.append(' '.join(current))
+                    current = []
+                current.append(word)
+            lines.append(' '.join(current))
+            return [piece for line in lines for piece in self._wrap(line)]
+
+        tokens = self._tokens(phrase)
+        size = math.ceil(len(tokens) / math.ceil(len(tokens) / self.max_phrase))
+        return [''.join(tokens[i:i + size]) for i in range(0, len(tokens), size)]
+
+
+rhythm_polisher = RhythmPolisher(max_phrase=app.config['POLISH_LOCAL_MAX_PHRASE'])
+
+class LyricsPolisher:
+    MODEL = "abab5.5-chat"
+    # 修改 SYSTEM_PROMPT、请求参数或分块方式时需要提升版本号，使旧的润色缓存失效
+    PROMPT_VERSION = 3
+    SYSTEM_PROMPT = """你是一个专业的语义节奏大师。你的任务是：
+1. 分析输入歌词语义
+2. 仅通过添加换行符来添加节奏和停顿：
+   - 使用双换行符"\n"表示短停顿
+   - 使用双换行符"\n\n"表示长停顿
+3. 不要修改任何原始歌词内容
+4. 不要添加任何其他标点或符号
+5. 不要添加任何额外说明或注释"""
+
+    def __init__(self):
+        self.api_key = os.getenv('MINIMAX_API_KEY')
+        self.group_id = os.getenv('MINIMAX_GROUP_ID')
+        if not self.api_key or not self.group_id:
+            raise ValueError("Missing required environment variables")
+        self.url = f"{app.config['MINIMAX_BASE_URL']}/v1/text/chatcompletion_v2"
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "mm-group-id": self.group_id
+        }
+        # hedged 模式下超过截止时间后仍在后台运行的接口请求
+        self._background = set()
+        logging.info("LyricsPolisher initialized")
+    
+    @instrumented('polish_lyrics')
+    async def polish_lyrics(self, original_lyrics, use_cache=True, progress=None):
+        """
+        异步润色歌词，按 POLISH_MODE 使用 Minimax API、本地规则或两者对冲
+        :param use_cache: 为 False 时跳过缓存强制重新润色（结果仍会写回缓存）
+        :param progress: 流式输出回调，progress('lyrics_delta', {'text', 'chunk'})；重试某一块前会收到 lyrics_reset {'chunk'}
+        """
+        mode = app.config['POLISH_MODE']
+        if mode == 'local':
+            return rhythm_polisher.polish(original_lyrics)
+        if mode == 'hedged':
+            return await self._polish_hedged(original_lyrics, use_cache, progress)
+        return await self._polish_with_llm(original_lyrics, use_cache, progress)
+
+    async def _polish_hedged(self, original_lyrics, use_cache, progress):
+        """
+        先请求接口，超过 POLISH_HEDGE_DEADLINE 仍未返回或请求失败时改用本地规则结果，
+        使润色阶段的耗时有确定的上限。超时的请求继续在后台完成并写入缓存，相同歌词下次直接命中
+        """
+        hedged = False
+
+        def report(event_type, data=None):
+            # 改用本地结果后不再转发接口的流式输出，避免覆盖已采用的结果
+            if progress and not hedged:
+                progress(event_type, data)
+
+        task = asyncio.ensure_future(self._polish_with_llm(original_lyrics, use_cache, report))
+        try:
+            polished_lyrics = await asyncio.wait_for(
+                asyncio.shield(task), app.config['POLISH_HEDGE_DEADLINE']
+            )
+        except asyncio.TimeoutError:
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+            reason = 'deadline'
+        else:
+            if polished_lyrics:
+                return polished_lyrics
+            reason = 'error'
+
+        hedged = True
+        metrics.inc('music_polish_fallback_total', reason=reason)
+        logging.warning("歌词润色%s，改用本地规则润色结果",
+                        "超过截止时间" if reason == 'deadline' else "失败")
+        return rhythm_polisher.polish(original_lyrics)
+
+    async def _polish_with_llm(self, original_lyrics, use_cache, progress):
+        """使用 Minimax API 润色歌词，失败时返回 None"""
+        try:
+            logging.info("开始润色歌词，长度: %d", len(original_lyrics))
+            logging.debug("待润色歌词: %s", repr(original_lyrics))
+
+            cache_key = PolishCache.make_key(original_lyrics, self.MODEL, self.PROMPT_VERSION)
+            if use_cache:
+                cached_lyrics = await asyncio.to_thread(polish_cache.get, cache_key)
+                if cached_lyrics:
+                    logging.info("命中歌词润色缓存")
+                    return cached_lyrics
+
+            # 相同歌词的并发润色只调用一次接口
+            return await polish_flight.do(
+                cache_key,
+                functools.partial(self._request_polish, original_lyrics, cache_key),
+                listener=progress
+            )
+
+        except Exception as e:
+            logging.error("歌词润色过程中发生错误: %s", str(e))
+            return None
+
+    @staticmethod
+    def split_chunks(lyrics, max_chars):
+        """
+        按段落（空行）把歌词切分为不超过 max_chars 的若干块，相邻的短段落合并到同一块；
+        单个段落过长时再按行切分，切开的各部分之间只有换行
+        :return: [(块, 是否接续上一块的段落)]，接续的块与上一块以换行连接、其余以空行连接即为原歌词
+                 （段落间的多个空行会被规整为一个）
+        """
+        stanzas = [stanza.strip('\n') for stanza in re.split(r'\n\s*\n', lyrics.strip()) if stanza.strip()]
+        pieces = []  # [(文本, 是否接续上一部分的段落)]
+        for stanza in stanzas:
+            if len(stanza) <= max_chars:
+                pieces.append((stanza, False))
+                continue
+            current, continues = [], False
+            for line in stanza.split('\n'):
+                if current and len('\n'.join(current + [line])) > max_chars:
+                    pieces.append(('\n'.join(current), continues))
+                    current, continues = [], True
+                current.append(line)
+            if current:
+                pieces.append(('\n'.join(current), continues))
+
+        chunks = []
+        for piece, continues in pieces:
+            separator = '\n' if continues else '\n\n'
+            if chunks and len(chunks[-1][0]) + len(separator) + len(piece) <= max_chars:
+                chunks[-1] = (chunks[-1][0] + separator + piece, chunks[-1][1])
+            else:
+                chunks.append((piece, continues))
+        return chunks or [(lyrics, False)]
+
+    @staticmethod
+    def join_chunks(chunks, texts):
+        """按 split_chunks 记录的段落关系把各块（润色后）的文本按原顺序连接"""
+        joined = ''
+        for (_, continues), text in zip(chunks, texts):
+            text = text.strip('\n')
+            if joined:
+                joined += '\n' if continues else '\n\n'
+            joined += text
+        return joined
+
+    # 中日韩文字和全角标点之间断行时不需要空格，其两侧的空白不计入内容
+    WIDE_CHARS = RhythmPolisher.CJK + '\u3000-\u303f\uff00-\uffef'
+
+    @classmethod
+    def preserves_content(cls, original, polished):
+        """
+        润色结果应与原文内容一致，只允许增删换行：连续的空白视为一个空格（其他文字的单词之间不能被合并），
+        中日韩文字两侧的空白忽略不计
+        """
+        def normalize(text):
+            text = re.sub(r'\s+', ' ', text.strip())
+            return re.sub(f'(?<=[{cls.WIDE_CHARS}]) | (?=[{cls.WIDE_CHARS}])', '', text)
+        return normalize(original) == normalize(polished)
+
+    async def _request_polish(self, original_lyrics, cache_key, report):
+        """
+        长歌词按段落分块并发润色，按原顺序合并后写入缓存，接口返回错误时返回 None
+        耗时约等于最长一块的耗时；只有校验失败的块会重新请求，多次失败的块保留原文
+        """
+        chunks = self.split_chunks(original_lyrics, app.config['POLISH_CHUNK_CHARS'])
+        if len(chunks) > 1:
+            logging.info("歌词分为 %d 块并发润色", len(chunks))
+        results = await asyncio.gather(*(
+            self._polish_chunk(chunk, continues, index, report) for index, (chunk, continues) in enumerate(chunks)
+        ))
+        if any(result is None for result in results):
+            return None
+
+        polished_lyrics = self.join_chunks(chunks, [text for text, _ in results]).strip()
+        # 直接在歌词前添加##，不添加任何换行符
+        final_lyrics = f"##" + polished_lyrics + "##"
+
+        # 记录处理结果
+        logging.info("歌词润色完成，长度: %d", len(final_lyrics))
+        logging.debug("润色后的歌词: %r", final_lyrics)
+
+        # 有块退回原文时不写缓存，下次重新润色
+        if all(verified for _, verified in results):
+            await asyncio.to_thread(polish_cache.put, cache_key, final_lyrics)
+        return final_lyrics
+
+    async def _polish_chunk(self, chunk, continues, index, report):
+        """
+        润色一块歌词，结果未通过内容校验时重新请求
+        :param continues: 是否接续上一块的段落，随进度一起报告，前端据此以换行或空行拼接各块
+        :return: (润色后的文本, 是否通过校验)，接口返回错误时返回 None
+        """
+        def chunk_report(event_type, data=None):
+            report(event_type, dict(data or {}, chunk=index, continues=continues))
+
+        attempts = app.config['POLISH_CHUNK_ATTEMPTS']
+        for attempt in range(1, attempts + 1):
+            polished = await self._request_chunk(chunk, chunk_report)
+            if polished is None:
+                return None
+            if self.preserves_content(chunk, polished):
+                return polished, True
+            metrics.inc('music_polish_rejected_total')
+            logging.warning("第 %d 块润色结果改动了歌词内容（第 %d/%d 次）", index + 1, attempt, attempts)
+
+        logging.warning("第 %d 块多次润色均未通过校验，保留原文", index + 1)
+        chunk_report('lyrics_reset')
+        chunk_report('lyrics_delta', {'text': chunk})
+        return chunk, False
+
+    async def _request_chunk(self, chunk, report):
+        """调用 chatcompletion 接口流式润色一块歌词，接口返回错误时返回 None"""
+        payload = {
+            "model": self.MODEL,
+            "stream": True,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": self.SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": chunk
+                }
+            ],
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "max_tokens": 2000,  # 增加 token 限制以适应更长的歌词
+            "echo": False 
+        }
+        
+        async def send():
+            # 重试时前端需要丢弃上一次尝试已输出的内容
+            report('lyrics_reset')
+            session = http_client.aiohttp_session()
+            async with session.post(self.url, headers=self.headers, json=payload,
+                                    timeout=http_client.aiohttp_timeout()) as response:
+                check_retryable_status(response.status, response.headers)
+                if response.status != 200:
+                    logging.error("API 响应内容: %s", await response.text())
+                    raise Exception(f"API 请求失败，状态码: {response.status}")
+                if 'text/event-stream' not in response.headers.get('Content-Type', ''):
+                    # 出错时接口直接返回普通 JSON
+                    response_text = await response.text()
+                    logging.debug("API 响应内容: %s", response_text)
+                    result = json.loads(response_text)
+                    check_minimax_base_resp(result)
+                    return result
+                return await self._read_polish_stream(response, report)
+
+        result = await call_with_retry_async('chat', send)
+        # 检查响应状态
+        if result.get("base_resp", {}).get("status_code") != 0:
+            error_msg = result.get("base_resp", {}).get("status_msg", "未知错误")
+            logging.error("API 返回错误: %s", error_msg)
+            return None
+        
+        # 获取润色后的歌词
+        if "choices" in result and len(result["choices"]) > 0:
+            # 获取润色后的歌词并去除首尾空白字符
+            return result["choices"][0]["message"]["content"].strip()
+        logging.error("响应中没有找到歌词内容")
+        return None
+
+    async def _read_polish_stream(self, response, report):
+        """
+        逐行解析流式响应，增量内容通过 report 转发
+        :return: 与非流式响应结构相同的结果
+        """
+        parts = []
+        final_content = None
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            check_minimax_base_resp(chunk)
+            if chunk.get('base_resp', {}).get('status_code', 0) != 0:
+                return chunk
+            for choice in chunk.get('choices') or []:
+                delta = (choice.get('delta') or {}).get('content')
+                if delta:
+                    parts.append(delta)
+                    report('lyrics_delta', {'text': delta})
+                # 最后一个数据块会带上完整的 message
+                message = choice.get('message') or {}
+                if message.get('content'):
+                    final_content = message['content']
+
+        content = final_content if final_content is not None else ''.join(parts)
+        logging.info("API 流式响应完成，长度: %d", len(content))
+        logging.debug("API 流式响应内容: %s", repr(content))
+        return {
+            'choices': [{'message': {'content': content}}],
+            'base_resp': {'status_code': 0}
+        }
+
+class PipelineError(Exception):
+    """流水线阶段失败，异常信息会直接作为任务的错误提示返回给前端"""
+
+
+class PipelineStage:
+    """
+    流水线中的一个阶段
+    :param name: 阶段名
+    :param run: 协程函数，参数为 {依赖阶段名: 结果}
+    :param deps: 依赖的阶段名
+    :param weight: 完成该阶段在总进度中所占的百分比
+    """
+
+    def __init__(self, name, run, deps=(), weight=0):
+        self.name = name
+        self.run = run
+        self.deps = tuple(deps)
+        self.weight = weight
+
+
+async def run_stage_graph(stages, on_change=None):
+    """
+    按依赖关系执行阶段图
+    依赖已满足的阶段会并发执行；任一阶段失败时取消其余仍在运行的阶段并重新抛出该异常
+    :param stages: PipelineStage 列表
+    :param on_change: 回调 on_change(阶段名, 状态)，状态为 running / done / failed / cancelled
+    :return: {阶段名: 结果}
+    """
+    def notify(name, state):
+        if on_change:
+            on_change(name, state)
+
+    results = {}
+    pending = {stage.name: stage for stage in stages}
+    running = {}  # task -> stage
+    try:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    del pending[name]
+                    task = asyncio.ensure_future(stage.run({dep: results[dep] for dep in stage.deps}))
+                    running[task] = stage
+                    notify(name, 'running')
+
+            if not running:
+                raise PipelineError(f"流水线存在无法满足的依赖: {', '.join(pending)}")
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stage = running.pop(task)
+                if task.exception() is not None:
+                    notify(stage.name, 'failed')
+                    raise task.exception()
+                results[stage.name] = task.result()
+                notify(stage.name, 'done')
+        return results
+    finally:
+        # 出错或外部取消时，取消仍在运行的兄弟阶段并等待其退出
+        for task, stage in running.items():
+            if not task.done():
+                task.cancel()
+            notify(stage.name, 'cancelled')
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+
+class JobSnapshotStore:
+    """
+    任务状态快照的持久化存储（SQLite）
+    多 worker 进程部署时任务只在提交它的进程中执行，其他进程通过快照查询任务状态
+    任务执行中的快照由后台线程写入，不阻塞任务事件循环；写入前同一任务的多次更新只保存最新的一次
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._initialized = False
+        self._pending = {}  # 任务 ID -> 等待保存快照的 GenerationJob
+        self._writing = False
+        self._pending_changed = threading.Condition()
+        self._writer = None
+
+    def _connect(self):
+        conn = connect_cache_db(self.db_path)
+        if not self._initialized:
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS job_snapshots ('
+                    'job_id TEXT PRIMARY KEY, '
+                    'snapshot TEXT NOT NULL, '
+                    'updated_at REAL NOT NULL)'
+                )
+                # 批量任务包含的任务 ID，其他进程据此汇总各任务的快照
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS job_batches ('
+                    'batch_id TEXT PRIMARY KEY, '
+                    'job_ids TEXT NOT NULL, '
+                    'created_at REAL NOT NULL)'
+                )
+                # 客户端最近一次查询任务的时间，与快照分开保存，避免被执行任务的进程覆盖
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS job_activity ('
+                    'job_id TEXT PRIMARY KEY, '
+                    'seen_at REAL NOT NULL)'
+                )
+            self._initialized = True
+        return conn
+
+    def touch(self, job_id):
+        """记录客户端在本进程查询了任务，执行任务的进程据此判断客户端是否仍在等待"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO job_activity (job_id, seen_at) VALUES (?, ?)',
+                         (job_id, time.time()))
+
+    def seen_at(self, job_id):
+        """:return: 客户端最近一次在其他进程查询任务的时间，没有记录时返回 None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT seen_at FROM job_activity WHERE job_id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, *snapshots):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO job_snapshots (job_id, snapshot, updated_at) VALUES (?, ?, ?)',
+                [(snapshot['job_id'], json.dumps(snapshot, ensure_ascii=False), snapshot['updated_at'])
+                 for snapshot in snapshots]
+            )
+
+    def save_later(self, job):
+        """在后台线程中保存任务的最新快照，立即返回"""
+        with self._pending_changed:
+            self._pending[job.id] = job
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_pending, name='job-snapshot-writer', daemon=True)
+                self._writer.start()
+            self._pending_changed.notify_all()
+
+    def flush(self, timeout=5):
+        """等待已提交的快照全部写入，进程退出前调用"""
+        with self._pending_changed:
+            self._pending_changed.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def _write_pending(self):
+        while True:
+            with self._pending_changed:
+                self._pending_changed.wait_for(lambda: self._pending)
+                jobs, self._pending = list(self._pending.values()), {}
+                self._writing = True
+            try:
+                # 在写入时才生成快照，排队期间的更新合并为一次写入
+                self.save(*(job.to_dict() for job in jobs))
+            except Exception as e:
+                logging.warning("保存任务快照失败: %s - %s", ', '.join(job.id for job in jobs), str(e))
+            finally:
+                with self._pending_changed:
+                    self._writing = False
+                    self._pending_changed.notify_all()
+
+    def get(self, job_id):
+        """:return: 任务快照（与 GenerationJob.to_dict 相同），不存在时返回 None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT snapshot FROM job_snapshots WHERE job_id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_batch(self, batch_id, job_ids, created_at):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO job_batches (batch_id, job_ids, created_at) VALUES (?, ?, ?)',
+                (batch_id, json.dumps(job_ids), created_at)
+            )
+
+    def get_batch(self, batch_id):
+        """:return: (任务 ID 列表, 创建时间)，不存在时返回 None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT job_ids, created_at FROM job_batches WHERE batch_id = ?',
+                               (batch_id,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def prune(self, expire_before):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM job_snapshots WHERE updated_at < ?', (expire_before,))
+            conn.execute('DELETE FROM job_batches WHERE created_at < ?', (expire_before,))
+            conn.execute('DELETE FROM job_activity WHERE seen_at < ?', (expire_before,))
+
+
+job_store = JobSnapshotStore(app.config['CACHE_DB_PATH'])
+
+
+class PipelineRunStore:
+    """
+    流水线运行记录的持久化存储（SQLite）
+    每次运行记录提交参数和各阶段的输出（下载路径、润色结果、上传 ID、生成的文件），
+    重试或进程重启后从第一个未完成的阶段继续执行；幂等键相同的重复提交对应同一条运行记录
+    执行中的运行由所在进程定期续租（更新 updated_at），超过租约时间未更新的运行可被其他进程接管
+    """
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._initialized = False
+
+    def _connect(self):
+        conn = connect_cache_db(self.db_path)
+        if not self._initialized:
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS pipeline_runs ('
+                    'run_id TEXT PRIMARY KEY, '
+                    'idempotency_key TEXT UNIQUE, '
+                    'job_id TEXT NOT NULL, '
+                    'request TEXT NOT NULL, '
+                    'outputs TEXT NOT NULL, '
+                    'status TEXT NOT NULL, '
+                    'owner TEXT NOT NULL, '
+                    'created_at REAL NOT NULL, '
+                    'updated_at REAL NOT NULL)'
+                )
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def _row_to_run(row):
+        run_id, idempotency_key, job_id, request_data, outputs, status, owner, created_at, updated_at = row
+        return {
+            'run_id': run_id,
+            'idempotency_key': idempotency_key,
+            'job_id': job_id,
+            'request': json.loads(request_data),
+            'outputs': json.loads(outputs),
+            'status': status,
+            'owner': owner,
+            'created_at': created_at,
+            'updated_at': updated_at
+        }
+
+    def _select(self, conn, where, params):
+        row = conn.execute(
+            'SELECT run_id, idempotency_key, job_id, request, outputs, status, owner, created_at, updated_at '
+            f'FROM pipeline_runs WHERE {where}', params
+        ).fetchone()
+        return self._row_to_run(row) if row else None
+
+    def create(self, run_id, job_id, request_data, owner, idempotency_key=None):
+        """
+        新建运行记录；幂等键已存在时不新建
+        :return: (运行记录, 是否新建)
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO pipeline_runs '
+                '(run_id, idempotency_key, job_id, request, outputs, status, owner, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, idempotency_key, job_id, json.dumps(request_data, ensure_ascii=False), '{}',
+                 'queued', owner, now, now)
+            )
+            if cursor.rowcount:
+                return self._select(conn, 'run_id = ?', (run_id,)), True
+            return self._select(conn, 'idempotency_key = ?', (idempotency_key,)), False
+
+    def get(self, run_id):
+        with closing(self._connect()) as conn:
+            return self._select(conn, 'run_id = ?', (run_id,))
+
+    def get_by_job(self, job_id):
+        """:return: 最近一次由该任务执行的运行记录"""
+        with closing(self._connect()) as conn:
+            return self._select(conn, 'job_id = ?', (job_id,))
+
+    def save_output(self, run_id, stage, output):
+        """记录一个阶段的输出（检查点）"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT outputs FROM pipeline_runs WHERE run_id = ?', (run_id,)).fetchone()
+            if not row:
+                return
+            outputs = json.loads(row[0])
+            outputs[stage] = {'value': output, 'saved_at': time.time()}
+            conn.execute(
+                'UPDATE pipeline_runs SET outputs = ?, updated_at = ? WHERE run_id = ?',
+                (json.dumps(outputs, ensure_ascii=False), time.time(), run_id)
+            )
+
+    def set_status(self, run_id, status):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'UPDATE pipeline_runs SET status = ?, updated_at = ? WHERE run_id = ?',
+                (status, time.time(), run_id)
+            )
+
+    def resume(self, run_id, job_id, owner):
+        """
+        把失败的运行重新置为排队状态并绑定新任务；并发的多次重试只有一次成功
+        :return: 是否成功接管
+        """
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "UPDATE pipeline_runs SET status = 'queued', job_id = ?, owner = ?, updated_at = ? "
+                "WHERE run_id = ? AND status = 'failed'",
+                (job_id, owner, time.time(), run_id)
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, owner, run_ids):
+        """为本进程中执行中的运行续租"""
+        if not run_ids:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'UPDATE pipeline_runs SET updated_at = ? WHERE run_id = ? AND owner = ?',
+                [(time.time(), run_id, owner) for run_id in run_ids]
+            )
+
+    def claim_stale(self, owner, expire_before, limit):
+        """
+        接管超过租约时间未续租的排队中/执行中的运行（所在进程已退出）
+        :return: 成功接管的运行记录列表
+        """
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                'SELECT run_id, updated_at FROM pipeline_runs '
+                'WHERE status IN (?, ?) AND updated_at < ? ORDER BY created_at LIMIT ?',
+                self.ACTIVE_STATUSES + (expire_before, limit)
+            ).fetchall()
+            claimed = []
+            for run_id, updated_at in rows:
+                cursor = conn.execute(
+                    "UPDATE pipeline_runs SET owner = ?, status = 'queued', updated_at = ? "
+                    'WHERE run_id = ? AND updated_at = ?',
+                    (owner, time.time(), run_id, updated_at)
+                )
+                if cursor.rowcount == 1:
+                    claimed.append(self._select(conn, 'run_id = ?', (run_id,)))
+            return claimed
+
+    def prune(self, expire_before):
+        """删除已结束且超过保留时间的运行记录"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'DELETE FROM pipeline_runs WHERE status NOT IN (?, ?) AND updated_at < ?',
+                self.ACTIVE_STATUSES + (expire_before,)
+            )
+
+
+run_store = PipelineRunStore(app.config['CACHE_DB_PATH'])
+
+
+class GenerationJob:
+    """
+    一次音乐生成任务的状态，由后台事件循环更新，由请求线程读取
+    状态变化和进度会记录为按顺序编号的事件，供 SSE 接口推送
+    """
+    TERMINAL_EVENTS = ('done', 'failed')
+
+    def __init__(self, suno_url, lyrics, fresh_polish=False, job_id=None, run_id=None, deadline=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.run_id = run_id or self.id  # 对应的流水线运行记录，重试时多个任务共用同一条记录
+        self.deadline = deadline or Deadline(app.config['JOB_DEADLINE_SECONDS'])
+        self.pipeline = None  # 执行中的流水线 asyncio.Task，只在事件循环线程中访问
+        self.watchers = 0  # 正在接收进度推送的 SSE 连接数
+        self.unwatched_at = None  # 最后一个 SSE 连接断开的时间，从未有过连接时为 None
+        self.suno_url = suno_url
+        self.lyrics = lyrics
+        self.fresh_polish = fresh_polish  # 为 True 时跳过润色缓存
+        self.status = 'queued'  # queued / running / succeeded / failed
+        self.stage = 'queued'
+        self.stages = {}  # 阶段名 -> waiting / running / done / failed / cancelled
+        self.timings = {}  # 阶段名 -> 耗时（秒），另含 queued 和 total
+        self.started_at = None
+        self.progress = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.finished_at = None
+        self.events = deque(maxlen=app.config['JOB_EVENT_BUFFER'])  # 最近的事件，更早的被丢弃
+        self.last_event_id = 0  # 第 n 个事件的 id 为 n
+        self._lock = threading.RLock()
+        self._events_changed = threading.Condition(self._lock)
+        self._async_waiters = []  # [(事件循环, asyncio.Event)]，ASGI 模式下的 SSE 连接
+
+    def emit(self, event_type, data=None):
+        """记录一个事件并唤醒等待中的 SSE 连接，可在任意线程调用"""
+        with self._lock:
+            self.last_event_id += 1
+            self.events.append({'id': self.last_event_id, 'event': event_type, 'data': data})
+            self._events_changed.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _events_after(self, after_id):
+        """after_id 之后的事件；其中一部分已被丢弃时，改为一个 id 为最新事件 id 的完整快照事件"""
+        with self._lock:
+            missed = self.last_event_id - after_id
+            if missed <= 0:
+                return []
+            if missed > len(self.events):
+                # 客户端落后于缓冲区，中间的事件已无法补发：发送当前完整状态，结束的任务转换为 done / failed
+                return [snapshot_to_event(self.to_dict(), self.last_event_id)]
+            return list(self.events)[-missed:]
+
+    def wait_events(self, after_id, timeout):
+        """
+        等待 after_id 之后的新事件
+        :return: 新事件列表（超时时为空）
+        """
+        with self._lock:
+            if self.last_event_id <= after_id:
+                self._events_changed.wait(timeout)
+            return self._events_after(after_id)
+
+    async def wait_events_async(self, after_id, timeout):
+        """wait_events 的异步版本，等待期间只占用一个协程"""
+        with self._lock:
+            if self.last_event_id > after_id:
+                return self._events_after(after_id)
+            changed = asyncio.Event()
+            self._async_waiters.append((asyncio.get_running_loop(), changed))
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._lock:
+            self._async_waiters = [waiter for waiter in self._async_waiters if waiter[1] is not changed]
+            return self._events_after(after_id)
+
+    def add_watcher(self):
+        with self._lock:
+            self.watchers += 1
+            self.unwatched_at = None
+
+    def remove_watcher(self):
+        with self._lock:
+            self.watchers -= 1
+            if not self.watchers:
+                self.unwatched_at = time.time()
+
+    def touch(self):
+        """客户端查询了任务状态：SSE 断开后退回到轮询的客户端仍在等待，重新开始计算断开时间"""
+        with self._lock:
+            if self.unwatched_at is not None:
+                self.unwatched_at = time.time()
+
+    def abandoned(self, grace, seen_at=None):
+        """
+        客户端曾经订阅过进度、所有连接都已断开且超过 grace 秒既未重连也未查询状态；只轮询状态的客户端不会被视为断开
+        :param seen_at: 客户端最近一次在其他 worker 进程查询任务的时间
+        """
+        with self._lock:
+            if self.finished_at is not None or self.watchers or self.unwatched_at is None:
+                return False
+            return time.time() - max(self.unwatched_at, seen_at or 0) >= grace
+
+    def persist(self, wait=False):
+        """
+        保存状态快照，供其他 worker 进程查询
+        :param wait: 为 True 时在当前线程中写入，否则交给后台线程，不阻塞任务事件循环
+        """
+        if not wait:
+            job_store.save_later(self)
+            return
+        try:
+            job_store.save(self.to_dict())
+        except Exception as e:
+            logging.warning("保存任务快照失败: %s - %s", self.id, str(e))
+
+    def update(self, **fields):
+        with self._lock:
+            previous_status = self.status
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.updated_at = time.time()
+            if self.status in ('succeeded', 'failed') and self.finished_at is None:
+                self.finished_at = self.updated_at
+            if self.status != previous_status:
+                if self.status == 'succeeded':
+                    self.emit('done', self.to_dict())
+                elif self.status == 'failed':
+                    self.emit('failed', {'message': self.error})
+                else:
+                    self.emit('status', {'status': self.status})
+        self.persist()
+
+    def record_timing(self, name, seconds):
+        with self._lock:
+            self.timings[name] = round(seconds, 3)
+
+    def set_stage_state(self, name, state, weight=0):
+        """记录单个阶段的状态，stage 字段取当前正在运行的阶段"""
+        with self._lock:
+            self.stages[name] = state
+            if state == 'done':
+                self.progress = min(self.progress + weight, 99)
+            running = [stage for stage, value in self.stages.items() if value == 'running']
+            if running:
+                self.stage = running[-1]
+            self.updated_at = time.time()
+            self.emit('stage', {'name': name, 'state': state, 'progress': self.progress})
+        self.persist()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'stage': self.stage,
+                'stages': dict(self.stages),
+                'progress': self.progress,
+                'timings': dict(self.timings),
+                'result': self.result,
+                'message': self.error,
+                'created_at': self.created_at,
+                'updated_at': self.updated_at,
+                'finished_at': self.finished_at
+            }
+
+
+class GenerationBatch:
+    """一组批量提交的生成任务"""
+
+    def __init__(self, jobs):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.created_at = time.time()
+
+    @property
+    def finished_at(self):
+        finished = [job.finished_at for job in self.jobs]
+        if any(value is None for value in finished):
+            return None
+        return max(finished)
+
+    def to_dict(self):
+        return self.summarize(self.id, self.created_at, [job.to_dict() for job in self.jobs])
+
+    @staticmethod
+    def summarize(batch_id, created_at, items):
+        """
+        汇总批量任务的状态
+        :param items: 各任务的 GenerationJob.to_dict 结果，任务在其他进程中执行时为快照
+        """
+        counts = defaultdict(int)
+        for item in items:
+            counts[item['status']] += 1
+        finished = [item['finished_at'] for item in items]
+        finished_at = None if any(value is None for value in finished) else max(finished, default=created_at)
+        return {
+            'batch_id': batch_id,
+            'status': 'completed' if finished_at is not None else 'running',
+            'total': len(items),
+            'succeeded': counts['succeeded'],
+            'failed': counts['failed'],
+            'elapsed': round((finished_at or time.time()) - created_at, 3),
+            'items': items
+        }
+
+
+class JobManager:
+    """
+    后台任务队列
+    所有任务在同一个常驻事件循环中由固定数量的 worker 协程执行，阻塞的上传调用放到有界线程池中运行
+    开发模式下事件循环运行在独立线程中；ASGI 模式下直接使用服务器的事件循环
+    """
+
+    def __init__(self, max_workers=8, max_pending=100, job_ttl=3600, stage_limits=None, drain_timeout=30,
+                 prefetch_ttl=900, run_lease=60, job_deadline=600, disconnect_grace=30):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.job_ttl = job_ttl
+        self.prefetch_ttl = prefetch_ttl
+        self.run_lease = run_lease  # 运行记录的租约时间（秒），见 PipelineRunStore
+        self.owner = uuid.uuid4().hex  # 本进程在运行记录中的标识
+        self._recovery = None  # 续租并接管中断运行的后台协程
+        self.job_deadline = job_deadline  # 任务默认及最长的截止时间（秒）
+        self.disconnect_grace = disconnect_grace  # SSE 连接全部断开后取消任务前的等待时间（秒），0 表示不取消
+        self._watchdog = None  # 取消已被客户端放弃的任务的后台协程
+        self.stage_limits = stage_limits or {}
+        self.drain_timeout = drain_timeout  # 关闭时等待进行中任务完成的最长时间（秒）
+        self._accepting = True
+        self._workers = []
+        self._stage_semaphores = {}  # 阶段名 -> asyncio.Semaphore，在事件循环线程中创建
+        self._jobs = {}
+        self._batches = {}
+        self._prefetches = {}  # 歌曲 ID -> 预取状态
+        self._lock = threading.Lock()
+        self._loop = None
+        self._queue = None  # asyncio.Queue，只在事件循环线程中访问
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generate')  # 上传和生成的阻塞调用
+        self._generator = None
+        self._polisher = None
+
+    @property
+    def started(self):
+        return self._loop is not None
+
+    @property
+    def owns_loop(self):
+        """事件循环是否由任务队列自己的线程运行（开发模式）"""
+        return self._thread is not None
+
+    def _on_loop(self):
+        """当前是否在任务事件循环中执行"""
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def start(self):
+        """启动后台事件循环线程（重复调用无副作用）"""
+        with self._lock:
+            if self._loop is not None or self._thread is not None:
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(ready,), name='job-loop', daemon=True)
+            self._thread.start()
+        ready.wait()
+
+    def attach(self, loop):
+        """在服务器的事件循环上启动 worker（ASGI 模式，需在该事件循环中调用）"""
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._setup(loop)
+
+    def _run_loop(self, ready):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._setup(loop)
+        ready.set()
+        loop.run_forever()
+
+    def _setup(self, loop):
+        self._queue = asyncio.Queue()
+        self._stage_semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.stage_limits.items()}
+        self._workers = [loop.create_task(self._worker(index)) for index in range(self.max_workers)]
+        self._recovery = loop.create_task(self._recover_runs())
+        if self.disconnect_grace > 0:
+            self._watchdog = loop.create_task(self._cancel_abandoned())
+        self._loop = loop
+        logging.info("任务队列已启动，worker 数量: %d", self.max_workers)
+        # 每个 worker 同时只执行一个任务，阶段上限超过 worker 数量时不会生效
+        total_limit = sum(self.stage_limits.values())
+        if self.max_workers < total_limit:
+            logging.warning("worker 数量 %d 小于各阶段并发上限之和 %d，等待生成等阶段的任务会占满 worker，"
+                            "其他阶段达不到 STAGE_LIMIT_* 设定的并发数", self.max_workers, total_limit)
+
+    def submit(self, suno_url, lyrics, fresh_polish=False, timeout=None):
+        """
+        提交生成任务
+        :param fresh_polish: 是否跳过润色缓存重新润色歌词
+        :param timeout: 从提交起的截止时间（秒），不超过 job_deadline，默认为 job_deadline
+        :return: GenerationJob，排队任务过多时返回 None
+        """
+        jobs = self._enqueue([{'suno_url': suno_url, 'lyrics': lyrics, 'fresh_polish': fresh_polish, 'timeout': timeout}])
+        return jobs[0] if jobs else None
+
+    def submit_idempotent(self, suno_url, lyrics, idempotency_key, fresh_polish=False, timeout=None):
+        """
+        按幂等键提交任务：相同键的重复提交返回已有的任务，已有的运行失败时从第一个未完成的阶段继续执行
+        :return: (任务 ID, 是否为新提交的任务)，排队任务过多时返回 None
+        """
+        job_id = uuid.uuid4().hex
+        request_data = {'suno_url': suno_url, 'lyrics': lyrics, 'fresh_polish': fresh_polish, 'timeout': timeout}
+        run, created = run_store.create(job_id, job_id, request_data, self.owner, idempotency_key)
+        if not created:
+            if run['status'] != 'failed':
+                return run['job_id'], False
+            resumed_job_id = self.resume_run(run)
+            return (resumed_job_id, True) if resumed_job_id else None
+        if not self._enqueue([dict(request_data, job_id=job_id, run_id=run['run_id'])]):
+            # 标记为失败，之后使用相同幂等键的重试可以继续执行
+            run_store.set_status(run['run_id'], 'failed')
+            return None
+        return job_id, True
+
+    def find_run(self, job_id):
+        """:return: 任务对应的运行记录，不存在时返回 None"""
+        job = self.get(job_id)
+        if job:
+            return run_store.get(job.run_id)
+        return run_store.get_by_job(job_id)
+
+    def resume_run(self, run):
+        """
+        从第一个未完成的阶段继续执行失败的运行，沿用运行记录中的提交参数
+        :return: 执行该运行的任务 ID（并发重试时可能是其他请求创建的任务），排队任务过多时返回 None
+        """
+        job_id = uuid.uuid4().hex
+        if not run_store.resume(run['run_id'], job_id, self.owner):
+            latest = run_store.get(run['run_id'])
+            return latest['job_id'] if latest else None
+        if not self._enqueue([dict(run['request'], job_id=job_id, run_id=run['run_id'])]):
+            run_store.set_status(run['run_id'], 'failed')
+            return None
+        logging.info("继续执行运行: %s，任务: %s", run['run_id'], job_id)
+        return job_id
+
+    def submit_batch(self, items):
+        """
+        批量提交生成任务，全部入队或全部拒绝
+        :param items: [{'suno_url', 'lyrics', 'fresh_polish'}]
+        :return: GenerationBatch，排队空间不足时返回 None
+        """
+        jobs = self._enqueue(items)
+        if not jobs:
+            return None
+        batch = GenerationBatch(jobs)
+        with self._lock:
+            self._batches[batch.id] = batch
+        # 保存批次包含的任务，多 worker 部署时其他进程也能查询批量任务
+        try:
+            job_store.save_batch(batch.id, [job.id for job in jobs], batch.created_at)
+        except Exception as e:
+            logging.warning("保存批量任务失败: %s - %s", batch.id, str(e))
+        logging.info("批量任务已入队: %s，共 %d 首", batch.id, len(jobs))
+        return batch
+
+    def _enqueue(self, items):
+        self.start()
+        with self._lock:
+            if not self._accepting:
+                logging.warning("服务正在关闭，拒绝新任务")
+                return None
+            self._prune()
+            pending = sum(1 for job in self._jobs.values() if job.status == 'queued')
+            if pending + len(items) > self.max_pending:
+                logging.warning("排队任务已满: %d", pending)
+                return None
+            jobs = [
+                GenerationJob(item['suno_url'], item['lyrics'], fresh_polish=item.get('fresh_polish', False),
+                              job_id=item.get('job_id'), run_id=item.get('run_id'),
+                              deadline=Deadline(min(item.get('timeout') or self.job_deadline, self.job_deadline)))
+                for item in items
+            ]
+            for job in jobs:
+                self._jobs[job.id] = job
+        # 提交任务的请求返回前快照必须已经可以查询（客户端的后续请求可能由其他 worker 处理），
+        # 在事件循环中接管运行时则交给后台线程写入
+        wait = not self._on_loop()
+        for item, job in zip(items, jobs):
+            if not item.get('run_id'):
+                self._create_run(job)
+            job.persist(wait=wait)
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, job)
+            logging.info("任务已入队: %s", job.id)
+        return jobs
+
+    def prefetch(self, suno_url):
+        """
+        预取参考音频：在后台下载并上传，之后提交的同一首歌的任务直接使用上传结果，跳过下载和上传阶段
+        同一首歌在有效期内只预取一次，失败的预取可以重新提交
+        :return: 预取状态（见 _prefetch_status），链接无效或进行中的预取过多时返回 None
+        """
+        song_id = extract_suno_song_id(suno_url)
+        if not song_id:
+            return None
+        self.start()
+        with self._lock:
+            if not self._accepting:
+                return None
+            self._prune_prefetches()
+            entry = self._prefetches.get(song_id)
+            if entry and entry['status'] != 'failed':
+                metrics.inc('music_prefetch_total', result='reused')
+                return self._prefetch_status(entry)
+            running = sum(1 for item in self._prefetches.values() if item['status'] == 'running')
+            if running >= self.max_pending:
+                logging.warning("进行中的预取过多: %d", running)
+                return None
+            entry = {
+                'song_id': song_id,
+                'status': 'running',
+                'reference': None,
+                'error': None,
+                'created_at': time.time(),
+                'finished_at': None
+            }
+            self._prefetches[song_id] = entry
+        metrics.inc('music_prefetch_total', result='started')
+        logging.info("开始预取: %s", song_id)
+        asyncio.run_coroutine_threadsafe(self._run_prefetch(entry, suno_url), self._loop)
+        return self._prefetch_status(entry)
+
+    def prefetched_reference(self, suno_url):
+        """
+        有效期内已完成预取的上传结果，上传缓存中的记录已失效（过期或生成时被判定为无效）时丢弃该预取
+        会查询上传缓存，在事件循环中需放到线程中调用
+        :return: 与 upload_reference 的返回值相同，没有时返回 None
+        """
+        song_id = extract_suno_song_id(suno_url)
+        with self._lock:
+            self._prune_prefetches()
+            entry = self._prefetches.get(song_id)
+            if not entry or entry['status'] != 'ready':
+                return None
+            reference = entry['reference']
+        if not self._upload_valid(reference):
+            logging.info("预取的上传结果已失效: %s", song_id)
+            self.discard_prefetch(reference['content_hash'])
+            return None
+        return dict(reference, cached=True)
+
+    def discard_prefetch(self, content_hash):
+        """丢弃上传结果为该内容哈希的已完成预取"""
+        with self._lock:
+            stale = [song_id for song_id, entry in self._prefetches.items()
+                     if entry['status'] == 'ready' and entry['reference']['content_hash'] == content_hash]
+            for song_id in stale:
+                del self._prefetches[song_id]
+
+    def prefetch_stats(self):
+        counts = {'running': 0, 'ready': 0, 'failed': 0}
+        with self._lock:
+            for entry in self._prefetches.values():
+                counts[entry['status']] += 1
+        return counts
+
+    @staticmethod
+    def _prefetch_status(entry):
+        """对外返回的预取状态，不包含上传结果"""
+        return {key: entry[key] for key in ('song_id', 'status', 'error', 'created_at', 'finished_at')}
+
+    def _prune_prefetches(self):
+        """清理已结束且超过有效期的预取（调用方需持有锁）"""
+        expire_before = time.time() - self.prefetch_ttl
+        expired = [song_id for song_id, entry in self._prefetches.items()
+                   if entry['finished_at'] is not None and entry['finished_at'] < expire_before]
+        for song_id in expired:
+            del self._prefetches[song_id]
+
+    def _create_run(self, job):
+        """为新任务创建运行记录（重试时使用同样长度的截止时间）"""
+        request_data = {
+            'suno_url': job.suno_url,
+            'lyrics': job.lyrics,
+            'fresh_polish': job.fresh_polish,
+            'timeout': job.deadline.remaining()
+        }
+        try:
+            run_store.create(job.run_id, job.id, request_data, self.owner)
+        except Exception as e:
+            logging.warning("创建运行记录失败: %s - %s", job.id, str(e))
+
+    def _set_run_status(self, job, status):
+        try:
+            run_store.set_status(job.run_id, status)
+        except Exception as e:
+            logging.warning("更新运行记录失败: %s - %s", job.run_id, str(e))
+
+    async def _recover_runs(self):
+        """
+        定期为本进程中未完成的运行续租，并接管超过租约时间未续租的运行
+        （所在进程已退出，包括重启前的本进程），接管的运行沿用原任务 ID 从第一个未完成的阶段继续执行
+        """
+        interval = max(self.run_lease / 3, 1)
+        while True:
+            try:
+                with self._lock:
+                    active = [job.run_id for job in self._jobs.values() if job.finished_at is None]
+                    pending = sum(1 for job in self._jobs.values() if job.status == 'queued')
+                    accepting = self._accepting
+                await asyncio.to_thread(run_store.heartbeat, self.owner, active)
+                capacity = self.max_pending - pending
+                if accepting and capacity > 0:
+                    runs = await asyncio.to_thread(
+                        run_store.claim_stale, self.owner, time.time() - self.run_lease, capacity
+                    )
+                    for run in runs:
+                        logging.info("接管中断的运行: %s，任务: %s", run['run_id'], run['job_id'])
+                        if not self._enqueue([dict(run['request'], job_id=run['job_id'], run_id=run['run_id'])]):
+                            await asyncio.to_thread(run_store.set_status, run['run_id'], 'failed')
+            except Exception as e:
+                logging.warning("续租或接管运行记录失败: %s", str(e))
+            await asyncio.sleep(interval)
+
+    def _cancel(self, job, message, reason):
+        """
+        取消任务（需在任务事件循环中调用）：排队中的任务直接失败，执行中的任务取消进行中的阶段，
+        各阶段在取消时删除未完成的临时文件；运行记录标记为失败，之后可以重试
+        """
+        if job.deadline.cancel_reason is not None or job.finished_at is not None:
+            return
+        job.deadline.cancel(message)
+        metrics.inc('music_jobs_cancelled_total', reason=reason)
+        logging.warning("%s: %s", message, job.id)
+        if job.pipeline is not None:
+            job.pipeline.cancel()
+        elif job.status == 'queued':
+            job.update(status='failed', error=message)
+            self._set_run_status(job, 'failed')
+
+    async def _cancel_abandoned(self):
+        """取消客户端已断开（SSE 连接全部断开超过 disconnect_grace 秒仍未重连）的任务"""
+        while True:
+            await asyncio.sleep(min(self.disconnect_grace, 1))
+            with self._lock:
+                jobs = [job for job in self._jobs.values() if job.abandoned(self.disconnect_grace)]
+            for job in jobs:
+                # 多 worker 部署时客户端可能在其他进程重连或轮询，取消前再检查快照存储中的查询记录
+                try:
+                    seen_at = await asyncio.to_thread(job_store.seen_at, job.id)
+                except Exception as e:
+                    logging.warning("读取任务查询记录失败: %s - %s", job.id, str(e))
+                    seen_at = None
+                if job.abandoned(self.disconnect_grace, seen_at):
+                    self._cancel(job, '客户端已断开，任务已取消', 'disconnect')
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def snapshot(self, job_id):
+        """
+        任务状态快照，本进程中没有该任务时（多 worker 部署）从快照存储中读取
+        :return: GenerationJob.to_dict 的结果，任务不存在时返回 None
+        """
+        job = self.get(job_id)
+        if job:
+            return job.to_dict()
+        try:
+            return job_store.get(job_id)
+        except Exception as e:
+            logging.warning("读取任务快照失败: %s - %s", job_id, str(e))
+            return None
+
+    def touch(self, job_id):
+        """记录客户端查询了任务，任务在其他 worker 进程中执行时写入快照存储"""
+        job = self.get(job_id)
+        if job:
+            job.touch()
+            return
+        try:
+            job_store.touch(job_id)
+        except Exception as e:
+            logging.warning("记录任务查询失败: %s - %s", job_id, str(e))
+
+    def batch_snapshot(self, batch_id):
+        """
+        批量任务的状态汇总，本进程中没有该批次时（多 worker 部署）根据快照存储中的任务快照汇总
+        :return: GenerationBatch.to_dict 的结果，批次不存在时返回 None
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch:
+            return batch.to_dict()
+        try:
+            stored = job_store.get_batch(batch_id)
+        except Exception as e:
+            logging.warning("读取批量任务失败: %s - %s", batch_id, str(e))
+            return None
+        if not stored:
+            return None
+        job_ids, created_at = stored
+        items = [self.snapshot(job_id) for job_id in job_ids]
+        return GenerationBatch.summarize(batch_id, created_at, [item for item in items if item])
+
+    def status_counts(self):
+        counts = {'queued': 0, 'running': 0, 'succeeded': 0, 'failed': 0}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def run_coroutine(self, coro, timeout=None):
+        """在任务事件循环上执行协程并同步等待结果，供事件循环以外的线程调用"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    async def drain(self, timeout=None):
+        """
+        优雅关闭：不再接受新任务，等待已提交的任务执行完毕，超时后取消剩余任务
+        需在任务事件循环中调用
+        """
+        if timeout is None:
+            timeout = self.drain_timeout
+        with self._lock:
+            self._accepting = False
+            unfinished = sum(1 for job in self._jobs.values() if job.finished_at is None)
+        logging.info("任务队列开始关闭，等待 %d 个未完成的任务", unfinished)
+        for task in (self._recovery, self._watchdog):
+            if task is not None:
+                task.cancel()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("等待任务完成超时（%s 秒），取消剩余任务", timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.finished_at is None]
+        # 运行记录保持执行中状态，租约过期后由重启后的进程或其他进程接管
+        for job in jobs:
+            job.update(status='failed', error='服务关闭，任务已取消')
+        self._workers = []
+
+    def stop(self):
+        """停止后台事件循环线程（开发模式），调用前应先执行 drain"""
+        with self._lock:
+            thread = self._thread
+        if thread is None or self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        thread.join(timeout=5)
+        self._executor.shutdown(wait=False)
+
+    def _prune(self):
+        """清理已结束且超过保留时间的任务（调用方需持有锁）"""
+        expire_before = time.time() - self.job_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < expire_before]
+        for job_id in expired:
+            del self._jobs[job_id]
+        expired_batches = [batch_id for batch_id, batch in self._batches.items()
+                           if batch.finished_at is not None and batch.finished_at < expire_before]
+        for batch_id in expired_batches:
+            del self._batches[batch_id]
+        if expired:
+            try:
+                job_store.prune(expire_before)
+                run_store.prune(expire_before)
+            except Exception as e:
+                logging.warning("清理任务快照失败: %s", str(e))
+
+    async def _worker(self, index):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run_job(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job):
+        token = current_job_id.set(job.id)
+        deadline_token = current_deadline.set(job.deadline)
+        try:
+            await self._execute_job(job)
+        finally:
+            current_deadline.reset(deadline_token)
+            current_job_id.reset(token)
+
+    def _run_blocking(self, func):
+        """在线程池中执行阻塞调用，并带上当前上下文（任务 ID 等日志字段）"""
+        context = contextvars.copy_context()
+        return self._loop.run_in_executor(self._executor, context.run, func)
+
+    async def _execute_job(self, job):
+        if job.finished_at is not None:
+            # 排队期间已被取消
+            return
+        logging.info("开始执行任务: %s", job.id)
+        job.started_at = time.time()
+        job.record_timing('queued', job.started_at - job.created_at)
+        job.update(status='running')
+        self._set_run_status(job, 'running')
+        try:
+            result = await self._run_until_deadline(job)
+            job.record_timing('total', time.time() - job.started_at)
+            job.update(status='succeeded', stage='done', progress=100, result=result)
+            self._set_run_status(job, 'succeeded')
+            logging.info("任务完成: %s", job.id)
+        except (PipelineError, DeadlineExceeded) as e:
+            logging.error("任务失败: %s - %s", job.id, str(e))
+            job.record_timing('total', time.time() - job.started_at)
+            job.update(status='failed', error=str(e))
+            self._set_run_status(job, 'failed')
+        except Exception as e:
+            logging.error("任务执行过程中发生错误: %s", str(e), exc_info=True)
+            job.record_timing('total', time.time() - job.started_at)
+            job.update(status='failed', error=f"错误: {str(e)}")
+            self._set_run_status(job, 'failed')
+
+    async def _run_until_deadline(self, job):
+        """
+        执行流水线，超过截止时间或任务被取消时取消所有进行中的阶段并抛出 DeadlineExceeded
+        各阶段在取消时自行删除未完成的临时文件（下载和生成的临时文件、截取的参考音频片段）
+        """
+        self._check_deadline(job)
+        pipeline = asyncio.ensure_future(self._run_pipeline(job))
+        job.pipeline = pipeline
+        try:
+            done, _ = await asyncio.wait({pipeline}, timeout=job.deadline.remaining())
+        finally:
+            job.pipeline = None
+            if not pipeline.done():
+                pipeline.cancel()
+                await asyncio.gather(pipeline, return_exceptions=True)
+
+        if done and not pipeline.cancelled() and pipeline.exception() is None:
+            return pipeline.result()
+        # 阶段因截止时间或取消而失败时，以取消原因作为错误信息
+        self._check_deadline(job)
+        if pipeline.cancelled():
+            raise PipelineError('任务已取消')
+        return pipeline.result()
+
+    @staticmethod
+    def _check_deadline(job):
+        if job.deadline.expired and job.deadline.cancel_reason is None:
+            metrics.inc('music_jobs_cancelled_total', reason='deadline')
+            logging.warning("任务超过截止时间，已取消: %s", job.id)
+        job.deadline.check()
+
+    @asynccontextmanager
+    async def _stage_slot(self, name):
+        """占用一个阶段并发名额（没有配置上限的阶段不限制）"""
+        semaphore = self._stage_semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        async with semaphore:
+            yield
+
+    def _clients(self):
+        """首次使用时创建 MusicGenerator 和 LyricsPolisher（需要 API 密钥）"""
+        if self._generator is None:
+            self._generator = MusicGenerator()
+            self._polisher = LyricsPolisher()
+        return self._generator, self._polisher
+
+    async def _upload_reference(self, generator, voice_path, listener=None):
+        """计算内容哈希后上传参考音频（阻塞调用放到线程池中执行），相同内容的并发上传只执行一次"""
+        content_hash = await self._run_blocking(
+            functools.partial(generator.reference_hash, voice_path)
+        )
+        return await upload_flight.do(
+            content_hash,
+            lambda report: self._run_blocking(
+                functools.partial(generator.upload_reference, voice_path, content_hash, report)
+            ),
+            listener=listener
+        )
+
+    async def _run_prefetch(self, entry, suno_url):
+        """在任务事件循环中执行预取，与生成任务共用下载和上传阶段的并发上限"""
+        token = current_job_id.set(f"prefetch-{entry['song_id']}")
+        current_deadline.set(Deadline(self.job_deadline))
+        try:
+            generator, _ = self._clients()
+            async with self._stage_slot('downloading'):
+                voice_path = await generator.download_suno_audio(suno_url)
+            if not voice_path:
+                raise PipelineError('音频下载失败')
+            async with self._stage_slot('uploading'):
+                reference = await self._upload_reference(generator, voice_path)
+            if not reference:
+                raise PipelineError('音频上传失败')
+        except Exception as e:
+            logging.warning("预取失败: %s - %s", entry['song_id'], str(e))
+            status, reference, error = 'failed', None, str(e)
+        else:
+            logging.info("预取完成: %s", entry['song_id'])
+            status, error = 'ready', None
+        finally:
+            current_job_id.reset(token)
+        with self._lock:
+            entry.update(status=status, reference=reference, error=error, finished_at=time.time())
+
+    def _load_checkpoints(self, job):
+        """
+        读取运行记录中仍然有效的阶段输出：下载和生成的文件需仍然存在，上传 ID 需仍在上传缓存中（未过期、未失效）
+        后续阶段的输出有效时不再需要其依赖的阶段
+        :return: {阶段名: 输出}
+        """
+        try:
+            run = run_store.get(job.run_id)
+        except Exception as e:
+            logging.warning("读取运行记录失败: %s - %s", job.run_id, str(e))
+            return {}
+        if not run:
+            return {}
+        outputs = run['outputs']
+
+        def value(name):
+            return outputs[name]['value'] if name in outputs else None
+
+        checkpoints = {}
+        if value('downloading') and os.path.exists(value('downloading')):
+            checkpoints['downloading'] = value('downloading')
+        # 上传 ID 过期或在生成时被判定为失效（已从上传缓存中删除）时重新上传，不沿用运行记录中的 ID
+        if value('uploading') and self._upload_valid(value('uploading')):
+            checkpoints['uploading'] = value('uploading')
+            checkpoints.setdefault('downloading', value('downloading'))
+        if value('polishing'):
+            checkpoints['polishing'] = value('polishing')
+        if value('generating') and os.path.exists(value('generating')):
+            checkpoints['generating'] = value('generating')
+            for name in ('downloading', 'uploading', 'polishing'):
+                checkpoints.setdefault(name, value(name))
+        return checkpoints
+
+    @staticmethod
+    def _upload_valid(reference):
+        try:
+            return upload_cache.is_valid(reference)
+        except Exception as e:
+            logging.warning("检查上传结果失败: %s - %s", reference.get('content_hash'), str(e))
+            return False
+
+    def _checkpointed(self, job, name, run, checkpoints):
+        """包装阶段函数：已有有效输出时直接返回，否则执行后把输出保存到运行记录"""
+        async def wrapper(deps):
+            if name in checkpoints:
+                logging.info("阶段 %s 已完成，沿用运行记录中的输出", name)
+                return checkpoints[name]
+            result = await run(deps)
+            try:
+                await asyncio.to_thread(run_store.save_output, job.run_id, name, result)
+            except Exception as e:
+                logging.warning("保存阶段输出失败: %s - %s", name, str(e))
+            return result
+        return wrapper
+
+    def _limited(self, job, name, run):
+        """包装阶段函数：按阶段并发上限排队执行，并记录该阶段的实际执行耗时"""
+        async def wrapper(deps):
+            semaphore = self._stage_semaphores.get(name)
+            job.set_stage_state(name, 'waiting')
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                job.set_stage_state(name, 'running')
+                started = time.monotonic()
+                try:
+                    return await run(deps)
+                finally:
+                    job.record_timing(name, time.monotonic() - started)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+        return wrapper
+
+    async def _run_pipeline(self, job):
+        generator, polisher = self._clients()
+        # 重试或接管的运行跳过已完成的阶段
+        checkpoints = await asyncio.to_thread(self._load_checkpoints, job)
+        if checkpoints:
+            logging.info("从运行记录继续执行，已完成的阶段: %s", ', '.join(checkpoints))
+        # 已预取的歌曲直接使用上传结果，只需润色和生成
+        prefetched = await asyncio.to_thread(self.prefetched_reference, job.suno_url)
+        if prefetched:
+            logging.info("使用预取的参考音频: %s", prefetched['content_hash'])
+
+        # 下载 -> 上传 与 润色歌词互不依赖，并发执行；生成阶段依赖上传和润色的结果
+        async def download(deps):
+            if prefetched:
+                return None
+            downloaded_file = await generator.download_suno_audio(job.suno_url, progress=job.emit)
+            if not downloaded_file:
+                raise PipelineError('音频下载失败')
+            return downloaded_file
+
+        async def upload(deps):
+            if prefetched:
+                return prefetched
+            reference = await self._upload_reference(generator, deps['downloading'], listener=job.emit)
+            if not reference:
+                raise PipelineError('音频上传失败')
+            return reference
+
+        async def polish(deps):
+            polished_lyrics = await polisher.polish_lyrics(
+                job.lyrics,
+                use_cache=not job.fresh_polish,
+                progress=job.emit
+            )
+            if not polished_lyrics:
+                raise PipelineError('歌词润色失败')
+            job.emit('lyrics', {'text': polished_lyrics})
+            return polished_lyrics
+
+        async def generate(deps):
+            output_file = await generator.generate_music(
+                reference=deps['uploading'],
+                lyrics=deps['polishing']
+            )
+            if not output_file:
+                raise PipelineError('音乐生成失败')
+            return output_file
+
+        def stage(name, run):
+            return self._checkpointed(job, name, self._limited(job, name, run), checkpoints)
+
+        stages = [
+            PipelineStage('downloading', stage('downloading', download), weight=20),
+            PipelineStage('uploading', stage('uploading', upload), deps=('downloading',), weight=20),
+            PipelineStage('polishing', stage('polishing', polish), weight=15),
+            PipelineStage('generating', stage('generating', generate),
+                          deps=('uploading', 'polishing'), weight=45)
+        ]
+        weights = {stage.name: stage.weight for stage in stages}
+
+        def on_change(name, state):
+            # running 状态由 _limited 在拿到并发名额后设置
+            if state != 'running':
+                job.set_stage_state(name, state, weights[name])
+
+        results = await run_stage_graph(stages, on_change=on_change)
+        output_file = results['generating']
+        polished_lyrics = results['polishing']
+
+        return {
+            'audio_url': f'/audio/{os.path.basename(output_file)}',
+            'polished_lyrics': polished_lyrics
+        }
+
+
+job_manager = JobManager(
+    max_workers=app.config['GENERATE_WORKERS'],
+    max_pending=app.config['GENERATE_MAX_PENDING'],
+    job_ttl=app.config['JOB_TTL_SECONDS'],
+    stage_limits=app.config['STAGE_LIMITS'],
+    drain_timeout=app.config['SHUTDOWN_DRAIN_TIMEOUT'],
+    prefetch_ttl=app.config['PREFETCH_TTL_SECONDS'],
+    run_lease=app.config['RUN_LEASE_SECONDS'],
+    job_deadline=app.config['JOB_DEADLINE_SECONDS'],
+    disconnect_grace=app.config['DISCONNECT_GRACE_SECONDS']
+)
+
+# 添加路由处理
+@app.before_request
+def bind_request_id():
+    """为每个请求分配 ID（沿用上游代理传入的 X-Request-ID），写入该请求产生的所有日志"""
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+    request.environ['music.request_id'] = request_id
+    request.environ['music.request_id_token'] = current_request_id.set(request_id)
+
+@app.after_request
+def expose_request_id(response):
+    request_id = request.environ.get('music.request_id')
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    return response
+
+@app.teardown_request
+def unbind_request_id(exc):
+    token = request.environ.pop('music.request_id_token', None)
+    if token is not None:
+        current_request_id.reset(token)
+
+@app.route('/')
+def index():
+    return send_from_directory('static', 'index.html')
+
+@app.route('/api/generate', methods=['POST'])
+def generate():
+    """提交生成任务，立即返回任务 ID，由后台 worker 执行完整流水线"""
+    try:
+        logging.info("收到生成请求")
+        data = request.json
+        # 请求中包含用户歌词，只在 DEBUG 级别记录
+        logging.debug("请求数据: %s", json.dumps(data, ensure_ascii=False))
+        
+        suno_url = data.get('suno_url')
+        original_lyrics = data.get('lyrics')
+
+        if not suno_url or not original_lyrics:
+            logging.error("缺少必要参数")
+            return jsonify({
+                'success': False,
+                'message': '请供完整的参数'
+            }), 400
+
+        # 带幂等键的重复提交返回已有的任务，已失败的任务从第一个未完成的阶段继续执行
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        fresh_polish = bool(data.get('fresh_polish'))
+        # 可选的截止时间（秒），从提交起计算，不超过 JOB_DEADLINE_SECONDS
+        timeout = data.get('timeout')
+        # bool 是 int 的子类，true 不能被当作 1 秒
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+            return jsonify({
+                'success': False,
+                'message': 'timeout 必须为正数（秒）'
+            }), 400
+        if idempotency_key:
+            submitted = job_manager.submit_idempotent(suno_url, original_lyrics, idempotency_key,
+                                                      fresh_polish=fresh_polish, timeout=timeout)
+            job_id, created = submitted if submitted else (None, False)
+        else:
+            job = job_manager.submit(suno_url, original_lyrics, fresh_polish=fresh_polish, timeout=timeout)
+            job_id, created = (job.id, True) if job else (None, False)
+        if not job_id:
+            return jsonify({
+                'success': False,
+                'message': '当前排队任务过多，请稍后再试'
+            }), 503
+
+        return jsonify(job_links(job_id)), 202 if created else 200
+
+    except Exception as e:
+        logging.error(f"处理请求时发生错误: {str(e)}")
+        logging.error("完整错误信息: ", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': f"错误: {str(e)}"
+        }), 500
+
+def job_links(job_id):
+    return {
+        'success': True,
+        'job_id': job_id,
+        'status_url': f'/api/jobs/{job_id}',
+        'events_url': f'/api/generate/{job_id}/events'
+    }
+
+@app.route('/api/jobs/<job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """重试失败的任务，跳过已完成的阶段（下载、上传、润色的结果沿用运行记录）"""
+    run = job_manager.find_run(job_id)
+    if not run:
+        return jsonify({
+            'success': False,
+            'message': '任务不存在或已过期'
+        }), 404
+    if run['status'] != 'failed':
+        return jsonify(dict(job_links(run['job_id']), success=False, message='任务未失败，无需重试')), 409
+
+    new_job_id = job_manager.resume_run(run)
+    if not new_job_id:
+        return jsonify({
+            'success': False,
+            'message': '当前排队任务过多，请稍后再试'
+        }), 503
+    return jsonify(job_links(new_job_id)), 202
+
+@app.route('/api/prefetch', methods=['POST'])
+def prefetch():
+    """预取参考音频：页面输入 Suno 链接后即调用，在用户编辑歌词期间提前完成下载和上传"""
+    try:
+        data = request.get_json(silent=True) or {}
+        suno_url = data.get('suno_url')
+        if not suno_url or not extract_suno_song_id(suno_url):
+            return jsonify({
+                'success': False,
+                'message': '无效的 Suno 链接'
+            }), 400
+
+        status = job_manager.prefetch(suno_url)
+        if not status:
+            return jsonify({
+                'success': False,
+                'message': '当前预取任务过多，请稍后再试'
+            }), 503
+
+        return jsonify({
+            'success': True,
+            'prefetch': status
+        }), 202
+
+    except Exception as e:
+        logging.error(f"处理预取请求时发生错误: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': f"错误: {str(e)}"
+        }), 500
+
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_batch():
+    """批量提交生成任务，返回批次 ID，各首歌曲分别经过下载、润色、上传、生成各阶段的并发限制"""
+    try:
+        data = request.json or {}
+        items = data.get('items')
+        logging.info("收到批量生成请求，共 %d 首", len(items) if isinstance(items, list) else 0)
+
+        if not isinstance(items, list) or not items:
+            return jsonify({
+                'success': False,
+                'message': '请提供 items 列表'
+            }), 400
+        if len(items) > app.config['BATCH_MAX_ITEMS']:
+            return jsonify({
+                'success': False,
+                'message': f"单次最多提交 {app.config['BATCH_MAX_ITEMS']} 首"
+            }), 400
+
+        normalized = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('suno_url') or not item.get('lyrics'):
+                return jsonify({
+                    'success': False,
+                    'message': f'第 {index + 1} 项缺少 suno_url 或 lyrics'
+                }), 400
+            normalized.append({
+                'suno_url': item['suno_url'],
+                'lyrics': item['lyrics'],
+                'fresh_polish': bool(item.get('fresh_polish'))
+            })
+
+        batch = job_manager.submit_batch(normalized)
+        if not batch:
+            return jsonify({
+                'success': False,
+                'message': '当前排队任务过多，请稍后再试'
+            }), 503
+
+        return jsonify({
+            'success': True,
+            'batch_id': batch.id,
+            'job_ids': [job.id for job in batch.jobs],
+            'status_url': f'/api/batches/{batch.id}'
+        }), 202
+
+    except Exception as e:
+        logging.error(f"处理批量请求时发生错误: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': f"错误: {str(e)}"
+        }), 500
+
+@app.route('/api/batches/<batch_id>')
+def get_batch(batch_id):
+    """查询批量任务中每首歌曲的状态、结果和各阶段耗时"""
+    batch = job_manager.batch_snapshot(batch_id)
+    if not batch:
+        return jsonify({
+            'success': False,
+            'message': '批量任务不存在'
+        }), 404
+    return jsonify({
+        'success': True,
+        'batch': batch
+    })
+
+def format_sse(event):
+    """把任务事件编码为 SSE 消息"""
+    data = json.dumps(event['data'], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+def parse_last_event_id(value):
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+def snapshot_to_event(snapshot, event_id):
+    """把其他进程中任务的快照转换为 SSE 事件，结束的任务转换为 done / failed"""
+    if snapshot['status'] == 'succeeded':
+        return {'id': event_id, 'event': 'done', 'data': snapshot}
+    if snapshot['status'] == 'failed':
+        return {'id': event_id, 'event': 'failed', 'data': {'message': snapshot['message']}}
+    return {'id': event_id, 'event': 'snapshot', 'data': snapshot}
+
+def snapshot_event_stream(job_id, interval=1.0):
+    """任务不在本进程时按快照的更新时间轮询推送（只包含状态和阶段，不含传输进度和流式歌词）"""
+    yield 'retry: 3000\n\n'
+    last_updated = None
+    last_touched = 0
+    event_id = 0
+    idle = 0.0
+    while True:
+        snapshot = job_manager.snapshot(job_id)
+        if not snapshot:
+            return
+        # 定期告知执行任务的进程客户端仍在等待，避免被当作已断开而取消
+        if time.time() - last_touched >= 5:
+            last_touched = time.time()
+            job_manager.touch(job_id)
+        if snapshot['updated_at'] != last_updated:
+            last_updated = snapshot['updated_at']
+            event_id += 1
+            idle = 0.0
+            event = snapshot_to_event(snapshot, event_id)
+            yield format_sse(event)
+            if event['event'] in GenerationJob.TERMINAL_EVENTS:
+                return
+        elif idle >= 15:
+            idle = 0.0
+            yield ': keepalive\n\n'
+        time.sleep(interval)
+        idle += interval
+
+@app.route('/api/generate/<job_id>/events')
+def job_events(job_id):
+    """
+    以 SSE 推送任务的阶段变化、下载/上传进度和流式润色的歌词，任务结束时发送 done / failed 后关闭
+    断线重连时根据 Last-Event-ID 从中断处继续
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        if job_manager.snapshot(job_id):
+            # 任务在其他 worker 进程中执行，轮询快照推送状态变化
+            return Response(snapshot_event_stream(job_id), mimetype='text/event-stream', headers=SSE_HEADERS)
+        return jsonify({
+            'success': False,
+            'message': '任务不存在'
+        }), 404
+
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+
+    def stream():
+        last_id = last_event_id
+        # 所有连接断开且超过 DISCONNECT_GRACE_SECONDS 未重连时取消任务（断开在下一次写入失败时才能发现）
+        job.add_watcher()
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                events = job.wait_events(last_id, timeout=15)
+                if not events:
+                    if job.finished_at is not None:
+                        return
+                    # 保持连接，防止代理因空闲断开
+                    yield ': keepalive\n\n'
+                    continue
+                for event in events:
+                    last_id = event['id']
+                    yield format_sse(event)
+                    if event['event'] in GenerationJob.TERMINAL_EVENTS:
+                        return
+        finally:
+            job.remove_watcher()
+
+    return Response(stream(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """查询生成任务的阶段、进度和结果"""
+    job_dict = job_manager.snapshot(job_id)
+    if not job_dict:
+        return jsonify({
+            'success': False,
+            'message': '任务不存在'
+        }), 404
+    # SSE 断开后退回到轮询的客户端仍在等待结果，不能被当作已断开而取消
+    if job_dict['finished_at'] is None:
+        job_manager.touch(job_id)
+    response = jsonify({
+        'success': True,
+        'job': job_dict
+    })
+    # 各阶段耗时同时以 Server-Timing 头返回，可在浏览器开发者工具中查看
+    if job_dict['timings']:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{name};dur={seconds * 1000:.1f}' for name, seconds in job_dict['timings'].items()
+        )
+    return response
+
+def collect_runtime_metrics():
+    """导出前刷新缓存命中率、限流器和任务队列相关的指标"""
+    polish_stats = polish_cache.stats()
+    metrics.set('music_cache_hit_ratio', polish_stats['hit_ratio'], cache='polish')
+    for cache in ('download', 'upload'):
+        hits = metrics.value('music_cache_hits_total', cache=cache)
+        misses = metrics.value('music_cache_misses_total', cache=cache)
+        metrics.set('music_cache_hit_ratio', hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+
+    for name, limiter in minimax_limiters.items():
+        stats = limiter.stats()
+        metrics.set('music_upstream_requests_total', stats['requests'], endpoint=name)
+        metrics.set('music_upstream_retries_total', stats['retries'], endpoint=name)
+        metrics.set('music_upstream_throttled_total', stats['throttled'], endpoint=name)
+        metrics.set('music_upstream_concurrency_limit', stats['concurrency_limit'], endpoint=name)
+        metrics.set('music_upstream_in_flight', stats['in_flight'], endpoint=name)
+
+    storage_stats = audio_store.stats()
+    metrics.set('music_storage_bytes', storage_stats['bytes'])
+    metrics.set('music_storage_files', storage_stats['files'])
+
+    for status, count in job_manager.status_counts().items():
+        metrics.set('music_jobs', count, status=status)
+
+metrics.add_collector(collect_runtime_metrics)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 文本格式的各阶段耗时、传输字节数、重试次数、缓存命中率和进行中的调用数"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats')
+def get_stats():
+    """各级缓存、连接池、Minimax 限流器和并发合并的统计信息"""
+    return jsonify({
+        'success': True,
+        'cache': {
+            'download': suno_download_cache.stats(),
+            'polish': polish_cache.stats()
+        },
+        'storage': audio_store.stats(),
+        'prefetch': job_manager.prefetch_stats(),
+        'http': http_client.stats(),
+        'rate_limits': {name: limiter.stats() for name, limiter in minimax_limiters.items()},
+        'single_flight': {flight.name: flight.stats() for flight in (download_flight, upload_flight, polish_flight)}
+    })
+
+# 音频文件 ETag 缓存：(路径, 修改时间, 大小) -> sha256
+_audio_etags = OrderedDict()
+_audio_etags_lock = threading.Lock()
+
+def audio_etag(file_path):
+    """以文件内容的 sha256 作为强 ETag，文件未变化时不重复计算"""
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    with _audio_etags_lock:
+        if key in _audio_etags:
+            _audio_etags.move_to_end(key)
+            return _audio_etags[key]
+    etag = file_sha256(file_path)
+    with _audio_etags_lock:
+        _audio_etags[key] = etag
+        while len(_audio_etags) > 1024:
+            _audio_etags.popitem(last=False)
+    return etag
+
+@app.route('/audio/<filename>')
+@instrumented('serve_audio', succeeded=lambda rv: app.make_response(rv).status_code < 400)
+def serve_audio(filename):
+    """
+    提供音频文件
+    默认内联返回供播放器使用，带 ?download=1 时作为附件下载；
+    支持 Range 分段请求（206）、强 ETag 条件请求（304）和长期缓存
+    """
+    # 由存储解析出绝对路径（分片目录或旧版本的平铺文件），避免 send_file 按应用根目录解析
+    file_path = audio_store.resolve(filename)
+    if not file_path:
+        logging.error(f"音频文件不存在: {filename}")
+        return jsonify({
+            'success': False,
+            'message': '文件不存在'
+        }), 404
+
+    try:
+        # conditional=True 时由 werkzeug 处理 Range / If-None-Match / If-Range，
+        # 文件体通过 wsgi.file_wrapper（sendfile）或 X-Sendfile 发送
+        response = send_file(
+            file_path,
+            mimetype='audio/mpeg',
+            as_attachment=request.args.get('download') == '1',
+            download_name=filename,
+            conditional=True,
+            etag=audio_store.etag_for(filename) or audio_etag(file_path),
+            max_age=app.config['AUDIO_CACHE_MAX_AGE']
+        )
+        response.headers['Cache-Control'] = f"public, max-age={app.config['AUDIO_CACHE_MAX_AGE']}, immutable"
+        if response.status_code in (200, 206) and response.content_length:
+            metrics.inc('music_bytes_total', response.content_length, stage='serve_audio', direction='out')
+        return response
+    except Exception as e:
         logging.error(f"提供音频文件时发生错误: {str(e)}")
         return jsonify({
             'success': False,
             'message': '文件不存在'
         }), 404
 
-# 修改 main 函数以支持异步
+class ThreadPoolWsgiToAsgi:
+    """
+    在线程池中执行 WSGI（Flask）请求的 ASGI 适配器，每个请求独占一个线程
+    响应按块发送，每块等待服务器接收后再继续，缓慢读取的客户端（如下载大音频）只阻塞它自己的线程，
+    不影响同一 worker 进程中的其他接口
+    """
+
+    def __init__(self, wsgi_app, max_threads=64):
+        self.wsgi_app = wsgi_app
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError(f"不支持的 ASGI 请求类型: {scope['type']}")
+        with tempfile.SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            loop = asyncio.get_running_loop()
+            context = contextvars.copy_context()
+            await loop.run_in_executor(self._executor, context.run, self._run, loop, scope, body, send)
+
+    def _run(self, loop, scope, body, send):
+        """在线程池中执行 WSGI 应用，通过事件循环发送响应"""
+        def send_message(message):
+            future = asyncio.run_coroutine_threadsafe(send(message), loop)
+            while True:
+                try:
+                    return future.result(timeout=1)
+                except concurrent.futures.TimeoutError:
+                    # 服务器已经退出时不再等待，避免线程永远挂起、进程无法退出
+                    if loop.is_closed():
+                        future.cancel()
+                        raise ConnectionError('事件循环已关闭')
+
+        response = {'start': None, 'started': False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response['started']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+            }
+
+        def send_start():
+            if not response['started']:
+                response['started'] = True
+                send_message(response['start'])
+
+        iterable = self.wsgi_app(self.build_environ(scope, body), start_response)
+        try:
+            for chunk in iterable:
+                send_start()
+                if chunk:
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_start()
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            # 关闭响应（如 send_file 打开的文件），客户端中途断开时也会执行
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    @staticmethod
+    def build_environ(scope, body):
+        script_name = scope.get('root_path', '').encode('utf-8').decode('latin1')
+        path_info = scope['path'].encode('utf-8').decode('latin1')
+        if script_name and path_info.startswith(script_name):
+            path_info = path_info[len(script_name):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name,
+            'PATH_INFO': path_info,
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+            value = value.decode('latin1')
+            # 重复的请求头按 WSGI 约定以逗号合并
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+        return environ
+
+    def close(self):
+        """关闭线程池，不再执行排队中的请求"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MusicAsgiApp:
+    """
+    生产 ASGI 入口：任务队列运行在服务器的事件循环上
+    SSE 连接直接由协程处理，每个等待中的连接只占用一个协程；其余请求交给 Flask，在线程池中并行执行
+    lifespan 关闭时等待进行中的任务完成后再退出
+    """
+    EVENTS_PATH = re.compile(r'^/api/generate/([0-9a-f]+)/events$')
+
+    def __init__(self, flask_app, manager, max_threads=64):
+        self.wsgi_app = ThreadPoolWsgiToAsgi(flask_app, max_threads)
+        self.manager = manager
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        # 同一长连接上的下一个请求会继承上一个请求遗留的上下文，
+        # 其中可能引用已经退出的执行器，因此每个请求都在新的空上下文中处理
+        task = contextvars.Context().run(asyncio.ensure_future, self._dispatch(scope, receive, send))
+        try:
+            await task
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+    async def _dispatch(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = self.EVENTS_PATH.match(scope['path'])
+            if match:
+                job_id = match.group(1)
+                job = self.manager.get(job_id)
+                if job:
+                    last_id = self._last_event_id(scope)
+                    return await self._send_sse(receive, send, self._job_events(job, last_id))
+                if await asyncio.to_thread(self.manager.snapshot, job_id):
+                    # 任务在其他 worker 进程中执行，轮询快照推送状态变化
+                    return await self._send_sse(receive, send, self._snapshot_events(job_id))
+        await self.wsgi_app(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.manager.attach(asyncio.get_running_loop())
+                audio_store.start_sweeper()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.manager.drain()
+                await http_client.close_async()
+                self.wsgi_app.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _last_event_id(scope):
+        headers = dict(scope['headers'])
+        query = dict(
+            pair.split('=', 1) for pair in scope.get('query_string', b'').decode().split('&') if '=' in pair
+        )
+        return parse_last_event_id(headers.get(b'last-event-id', b'').decode() or query.get('last_event_id'))
+
+    async def _job_events(self, job, last_id):
+        """本进程中的任务：等待新事件并逐条推送，结束事件之后停止；客户端断开时立即解除订阅"""
+        job.add_watcher()
+        try:
+            while True:
+                events = await job.wait_events_async(last_id, timeout=15)
+                if not events:
+                    if job.finished_at is not None:
+                        return
+                    # 保持连接，防止代理因空闲断开
+                    yield ': keepalive\n\n'
+                    continue
+                for event in events:
+                    last_id = event['id']
+                    yield format_sse(event)
+                    if event['event'] in GenerationJob.TERMINAL_EVENTS:
+                        return
+        finally:
+            job.remove_watcher()
+
+    async def _snapshot_events(self, job_id, interval=1.0):
+        """其他进程中的任务：与 snapshot_event_stream 相同，但用协程等待"""
+        last_updated = None
+        event_id = 0
+        idle = 0.0
+        while True:
+            snapshot = await asyncio.to_thread(self.manager.snapshot, job_id)
+            if not snapshot:
+                return
+            if snapshot['updated_at'] != last_updated:
+                last_updated = snapshot['updated_at']
+                event_id += 1
+                idle = 0.0
+                event = snapshot_to_event(snapshot, event_id)
+                yield format_sse(event)
+                if event['event'] in GenerationJob.TERMINAL_EVENTS:
+                    return
+            elif idle >= 15:
+                idle = 0.0
+                yield ': keepalive\n\n'
+            await asyncio.sleep(interval)
+            idle += interval
+
+    async def _send_sse(self, receive, send, events):
+        """发送 SSE 响应，客户端断开后立即停止"""
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + [
+                (key.lower().encode(), value.encode()) for key, value in SSE_HEADERS.items()
+            ]
+        })
+
+        async def stream():
+            yield 'retry: 3000\n\n'
+            async for message in events:
+                yield message
+
+        async def pump():
+            async for message in stream():
+                await send({'type': 'http.response.body', 'body': message.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        pump_task = asyncio.create_task(pump())
+        watch_task = asyncio.create_task(watch_disconnect())
+        try:
+            await asyncio.wait({pump_task, watch_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (pump_task, watch_task):
+                task.cancel()
+            await asyncio.gather(pump_task, watch_task, return_exceptions=True)
+
+
+def create_asgi_app():
+    return MusicAsgiApp(app, job_manager, max_threads=app.config['ASGI_THREADS'])
+
+asgi_app = create_asgi_app()
+
+def shutdown():
+    """进程退出时等待进行中的任务，关闭共享连接和后台事件循环（ASGI 模式下由 lifespan 完成前两步）"""
+    if job_manager.owns_loop:
+        try:
+            job_manager.run_coroutine(job_manager.drain(), timeout=job_manager.drain_timeout + 5)
+        except Exception as e:
+            logging.warning("关闭任务队列时发生错误: %s", str(e))
+        try:
+            job_manager.run_coroutine(http_client.close_async(), timeout=5)
+        except Exception as e:
+            logging.warning("关闭 aiohttp 会话时发生错误: %s", str(e))
+    job_manager.stop()
+    job_store.flush()
+    audio_store.stop_sweeper()
+    http_client.close()
+    # 最后停止日志写入线程，确保队列中剩余的日志全部落盘
+    log_listener.stop()
+
+atexit.register(shutdown)
+
 def main():
     # 确保必要的目录存在
     os.makedirs('static', exist_ok=True)
     os.makedirs('downloads', exist_ok=True)
     os.makedirs('logs', exist_ok=True)
 
-    # 启动异步 Flask 服务
-    app.run(debug=True, port=5000, use_reloader=False)
+    if app.config['ASGI_WORKERS'] > 0:
+        # 生产模式：多 worker 进程的 ASGI 服务器，每个进程一个常驻事件循环
+        import uvicorn
+        uvicorn.run(
+            'music:asgi_app',
+            host=app.config['HOST'],
+            port=app.config['PORT'],
+            workers=app.config['ASGI_WORKERS'],
+            lifespan='on',
+            timeout_graceful_shutdown=int(app.config['SHUTDOWN_DRAIN_TIMEOUT']) + 5
+        )
+        return
+
+    # 开发模式：启动后台任务队列、存储清理线程和 Flask 开发服务器
+    job_manager.start()
+    audio_store.start_sweeper()
+    app.run(debug=True, host=app.config['HOST'], port=app.config['PORT'], use_reloader=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file